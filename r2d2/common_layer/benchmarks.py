@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the currency conversion paths in r2d2.common_layer.currency, run with the
+benchmark_currency_conversion management command.
+
+Benchmarks build synthetic rates and line items and return their timings in seconds.
+Paths that read rates from the DB run against a test database created for the run (see
+benchmark_database()), never against the configured one.
+"""
+from contextlib import contextmanager
+from datetime import date, timedelta
+from decimal import Decimal
+import resource
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import override_settings
+import numpy as np
+import pandas as pd
+
+import r2d2.common_layer.currency as curr
+from r2d2.common_layer.models import ExchangeRate, ExchangeRateSource
+import r2d2.common_layer.models as clmodels
+import r2d2.common_layer.utils as clutils
+
+
+def timed(fn, *args, **kwargs):
+    """ Returns (seconds, result) of calling fn with the passed arguments """
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return (time.time() - start, result)
+
+
+def current_rss():
+    """ Returns the resident memory of this process in bytes, or None where /proc isn't available """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        return None
+
+
+def measured(fn, *args, **kwargs):
+    """
+    Returns (seconds, peak_bytes, result) of calling fn with the passed arguments.
+    peak_bytes is how far the resident memory rose above its level before the call,
+    sampled every millisecond (None where it can't be read, see current_rss())
+    """
+    start_rss = current_rss()
+    if start_rss is None:
+        (seconds, result) = timed(fn, *args, **kwargs)
+        return (seconds, None, result)
+
+    peak = [start_rss]
+    done = threading.Event()
+
+    def sample():
+        while not done.is_set():
+            peak[0] = max(peak[0], current_rss())
+            done.wait(0.001)
+
+    sampler = threading.Thread(target=sample)
+    sampler.daemon = True
+    sampler.start()
+    try:
+        (seconds, result) = timed(fn, *args, **kwargs)
+    finally:
+        done.set()
+        sampler.join()
+
+    return (seconds, max(peak[0], current_rss()) - start_rss, result)
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Runs the block against a test database, created as the test runner does, with the
+    (unmanaged) ExchangeRate tables, and a local memory cache so benchmark rates never
+    reach the shared cache.  The test database is destroyed afterwards
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        tables = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in [ExchangeRateSource, ExchangeRate]:
+                if model._meta.db_table not in tables:
+                    editor.create_model(model)
+
+        with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                                   'LOCATION': 'benchmarks'}}):
+            yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity)
+
+
+def synthetic_currencies(count):
+    """ Returns count distinct three letter currency codes """
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return [letters[i // 26 % 26] + letters[i % 26] + 'X' for i in range(count)]
+
+
+def synthetic_rate_dates(days, start=date(2015, 1, 1)):
+    """ Returns the weekdays (the days rates are published) of the days starting at start """
+    return [start + timedelta(days=day) for day in range(days) if (start + timedelta(days=day)).weekday() < 5]
+
+
+def synthetic_rates_index(currencies, days, base_currency='USD', start=date(2015, 1, 1)):
+    """
+    Returns rates to base_currency as returned by
+    r2d2.common_layer.currency.exchange_rates_index(), with a rate per currency for
+    every weekday of the days starting at start
+    """
+    dates = np.array(synthetic_rate_dates(days, start), dtype='datetime64[D]')
+    return dict(((currency, base_currency), (dates, np.array(np.linspace(0.5, 2.0, len(dates)), dtype=object)))
+                for currency in currencies)
+
+
+def load_synthetic_rates(currencies, days, base_currency='USD', start=date(2015, 1, 1)):
+    """
+    Writes the rates of synthetic_rates_index() to the ExchangeRate table, under a new
+    ExchangeRateSource, as the daily rates are fetched.  Returns the number of rates
+    """
+    rate_dates = synthetic_rate_dates(days, start)
+    source = ExchangeRateSource.objects.create(id=1, name=base_currency, last_update=rate_dates[-1],
+                                               base_currency=base_currency)
+
+    values = [Decimal('%.6f' % value) for value in np.linspace(0.5, 2.0, len(rate_dates))]
+    rates = [ExchangeRate(id=i * len(rate_dates) + j + 1, currency=currency, value=value, source=source,
+                          date=rate_date)
+             for (i, currency) in enumerate(currencies)
+             for (j, (rate_date, value)) in enumerate(zip(rate_dates, values))]
+    ExchangeRate.objects.bulk_create(rates)
+
+    return len(rates)
+
+
+def synthetic_transactions_df(rows, currencies, days, start=date(2015, 1, 1), seed=0):
+    """
+    Returns a DataFrame of rows line items with the date and currency_code columns of
+    CommonTransactionDataFrame.find(), spread over the days starting at start
+    """
+    random = np.random.RandomState(seed)
+    return pd.DataFrame({'date': pd.Timestamp(start) + pd.to_timedelta(random.randint(0, days * 24, rows), unit='h'),
+                         'currency_code': random.choice(currencies, rows)})
+
+
+def synthetic_line_items_df(rows, currencies, days, start=date(2015, 1, 1), seed=0, fixed_point=False):
+    """
+    Returns synthetic_transactions_df() with product_total and total_total columns,
+    drawn from a hundred distinct prices as in a real catalogue:  Decimals, or int64
+    minor units if fixed_point
+    """
+    df = synthetic_transactions_df(rows, currencies, days, start, seed)
+    random = np.random.RandomState(seed)
+    prices = [Decimal(int(cents)).scaleb(-2) for cents in random.randint(100, 100000, 100)]
+    if fixed_point:
+        prices = [clmodels.to_minor_units(price) for price in prices]
+
+    prices = np.array(prices, dtype=np.int64 if fixed_point else object)
+    df['product_total'] = prices[random.randint(0, len(prices), rows)]
+    df['total_total'] = prices[random.randint(0, len(prices), rows)]
+    return df
+
+
+def resolve_row_rates(df, rates, force_date=False):
+    """
+    Resolves the rate of every row of df as convert_common_transactions_df() does, and
+    returns the date of each row's rate
+    """
+    (codes, currencies, days) = curr.distinct_currency_days(df)
+    (rate_dates, values) = curr.resolve_rates(currencies, days, 'USD', rates, force_date)
+    return rate_dates.astype(object)[codes]
+
+
+def benchmark_rate_resolution(rows=1000000, currencies=10, days=730, sample=10000):
+    """
+    Times resolving the nearest rate of rows line items, as
+    convert_common_transactions_df(..., force_date=False) does.  The per-row
+    clutils.nearest() lookup it replaced is timed over a sample of them, and
+    extrapolated to rows, since running it in full takes minutes.
+
+    Returns a dict of the timings, and whether both lookups agree on the sample
+    """
+    rates = synthetic_rates_index(synthetic_currencies(currencies), days)
+    df = synthetic_transactions_df(rows, synthetic_currencies(currencies), days)
+
+    (vectorized, nearest) = timed(resolve_row_rates, df, rates)
+
+    sample_df = df.iloc[:sample]
+    rate_dates = synthetic_rate_dates(days)
+    (per_row, sample_nearest) = timed(sample_df.date.dt.date.apply, clutils.nearest, args=(rate_dates,))
+
+    return {'rows': rows,
+            'rates': sum(len(dates) for (dates, values) in rates.values()),
+            'resolve_rates': vectorized,
+            'per_row_nearest': per_row * rows / float(max(sample_df.shape[0], 1)),
+            'matches': nearest[:sample].tolist() == sample_nearest.tolist()}
+
+
+def benchmark_conversion_paths(sizes=(10000, 100000, 1000000, 5000000), currencies=10, days=730, sample=1000,
+                               fixed_point=False):
+    """
+    Times every currency conversion path against synthetic rates written to the DB, so
+    must run inside benchmark_database():
+    - get_rate(), MoneyConverter.get_rate_cached() and convert() (from the DB and from
+      the cache), over sample calls for random currencies and days, with force_date
+      False as days without a rate are drawn too
+    - MoneyConverter.load_exchange_rates()
+    - convert_common_transactions_df() with both force_date modes, over synthetic line
+      items of each of sizes rows (see synthetic_line_items_df())
+
+    Returns a dict of the number of rates and of one result per path and size:  its
+    seconds (and seconds per call or row) and peak_bytes (see measured())
+    """
+    currency_codes = synthetic_currencies(currencies)
+    rates = load_synthetic_rates(currency_codes, days)
+    cache.clear()  # drops the version of the rates cached before they were written
+    random = np.random.RandomState(0)
+    calls = [(currency_codes[i], date(2015, 1, 1) + timedelta(days=int(day)))
+             for (i, day) in zip(random.randint(0, currencies, sample), random.randint(0, days, sample))]
+    results = []
+
+    def per_call(path, fn):
+        (seconds, peak_bytes, _) = measured(lambda: [fn(currency, day) for (currency, day) in calls])
+        results.append({'path': path, 'calls': len(calls), 'seconds': seconds,
+                        'seconds_per_call': seconds / max(len(calls), 1), 'peak_bytes': peak_bytes})
+
+    per_call('get_rate', lambda currency, day: curr.get_rate(currency, 'USD', day, False))
+    per_call('convert', lambda currency, day: curr.convert(Decimal('9.99'), currency, 'USD', day, False))
+
+    (seconds, peak_bytes, _) = measured(curr.MoneyConverter.load_exchange_rates, True)
+    results.append({'path': 'MoneyConverter.load_exchange_rates', 'calls': 1, 'seconds': seconds,
+                    'seconds_per_call': seconds, 'peak_bytes': peak_bytes})
+    per_call('MoneyConverter.get_rate_cached',
+             lambda currency, day: curr.MoneyConverter.get_rate_cached(currency, 'USD', day, False))
+    per_call('convert(use_cache=True)',
+             lambda currency, day: curr.convert(Decimal('9.99'), currency, 'USD', day, False, use_cache=True))
+
+    for rows in sizes:
+        df = synthetic_line_items_df(rows, currency_codes + ['USD'], days, fixed_point=fixed_point)
+        for force_date in [True, False]:
+            frame = df.copy()
+            (seconds, peak_bytes, _) = measured(curr.convert_common_transactions_df, frame, 'USD', force_date)
+            results.append({'path': 'convert_common_transactions_df', 'force_date': force_date,
+                            'fixed_point': fixed_point, 'rows': rows, 'seconds': seconds,
+                            'seconds_per_row': seconds / max(rows, 1), 'peak_bytes': peak_bytes})
+            del frame
+
+    return {'rates': rates, 'results': results}
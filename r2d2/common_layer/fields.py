@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+""" common layer fields """
+from bson.int64 import Int64
+from decimal import Decimal
+
+from django.conf import settings
+from django_mongoengine import fields
+
+
+def money_as_minor_units():
+    """
+    Whether MoneyFields are written as integer minor units rather than BSON doubles
+    """
+    return getattr(settings, 'COMMON_LAYER_MONEY_AS_MINOR_UNITS', False)
+
+
+class MoneyField(fields.DecimalField):
+    """
+    DecimalField for monetary amounts.  When settings.COMMON_LAYER_MONEY_AS_MINOR_UNITS
+    is True values are stored exactly, as a BSON int64 count of minor units
+    (10 ** -precision), instead of as a BSON double.
+
+    Both representations are read back, so documents written before the setting was
+    enabled keep working.  Use the convert_money_to_minor_units management command to
+    rewrite them.  MongoDB 3.4's Decimal128 type would be the natural alternative but
+    requires pymongo 3.4+.
+    """
+    def to_python(self, value):
+        if isinstance(value, Int64):
+            return Decimal(value).scaleb(-self.precision)
+
+        return super(MoneyField, self).to_python(value)
+
+    def to_mongo(self, value, use_db_field=True):
+        if value is None or not money_as_minor_units():
+            return super(MoneyField, self).to_mongo(value, use_db_field)
+
+        return Int64(self.to_python(value).scaleb(self.precision).to_integral_value())
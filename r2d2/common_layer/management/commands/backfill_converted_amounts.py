@@ -0,0 +1,47 @@
+""" store the reporting currency amounts of existing CommonTransactions """
+from django.core.management.base import BaseCommand
+
+from r2d2.common_layer.currency import backfill_converted_amounts, get_reporting_currency, rates_version
+from r2d2.common_layer.models import CommonTransaction
+from r2d2.common_layer.tasks import backfill_converted_amounts_task
+
+
+class Command(BaseCommand):
+    """
+    Stores the amounts converted to the reporting currency of the CommonTransactions
+    imported without them:  before object_imported_handler stored them, or before the
+    rate of their day was fetched (see r2d2.common_layer.currency.store_converted_amounts()).
+
+    Documents that already hold them are skipped, so the command can safely be run again,
+    e.g. daily after the rates are fetched.  With --queue one Celery task is queued per
+    user, so the users are backfilled in parallel by the workers.
+    """
+    help = 'Stores the reporting currency amounts of existing CommonTransactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, dest='user_id', default=None,
+                            help='Only backfill the transactions of this user')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                            help='Number of documents updated per bulk write')
+        parser.add_argument('--queue', action='store_true', dest='queue', default=False,
+                            help='Queue one Celery task per user instead of backfilling in this process')
+
+    def handle(self, *args, **options):
+        if options['user_id'] is not None:
+            user_ids = [options['user_id']]
+        else:
+            to_curr = get_reporting_currency()
+            user_ids = CommonTransaction._get_collection().distinct(
+                'user_id', {'reporting_currency': {'$ne': to_curr}, 'rates_version': {'$ne': rates_version(to_curr)}})
+
+        if options['queue']:
+            for user_id in user_ids:
+                backfill_converted_amounts_task.delay(user_id, options['batch_size'])
+            self.stdout.write('%d backfill tasks queued' % len(user_ids))
+            return
+
+        updated = 0
+        for user_id in user_ids:
+            updated += backfill_converted_amounts(user_id, batch_size=options['batch_size'])
+
+        self.stdout.write('%d CommonTransactions backfilled' % updated)
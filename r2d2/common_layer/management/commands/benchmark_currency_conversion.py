@@ -0,0 +1,55 @@
+""" benchmark the currency conversion paths """
+import json
+import platform
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+import numpy as np
+import pandas as pd
+
+from r2d2.common_layer.benchmarks import benchmark_conversion_paths, benchmark_database, benchmark_rate_resolution
+
+
+class Command(BaseCommand):
+    """
+    Times the currency conversion paths over synthetic rates and line items (see
+    r2d2.common_layer.benchmarks), and writes the timings and peak memory of each as
+    JSON.  Rates are written to a test database created for the run, so the command
+    never touches the configured database's rates.
+    """
+    help = 'Benchmarks currency conversion over synthetic rates and line items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', dest='sizes', default='10000,100000,1000000,5000000',
+                            help='Comma separated numbers of line items converted')
+        parser.add_argument('--currencies', type=int, dest='currencies', default=10,
+                            help='Number of currencies with rates')
+        parser.add_argument('--days', type=int, dest='days', default=730,
+                            help='Number of days of rates and line items')
+        parser.add_argument('--sample', type=int, dest='sample', default=1000,
+                            help='Number of calls the per call paths are timed over')
+        parser.add_argument('--fixed-point', action='store_true', dest='fixed_point', default=False,
+                            help='Convert int64 minor units instead of Decimal amounts')
+        parser.add_argument('--output', dest='output', default=None,
+                            help='File the JSON results are written to, instead of stdout')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        with benchmark_database():
+            result = benchmark_conversion_paths(sizes, options['currencies'], options['days'], options['sample'],
+                                                options['fixed_point'])
+            result['database'] = connection.vendor
+
+        result['rate_resolution'] = benchmark_rate_resolution(max(sizes), options['currencies'], options['days'],
+                                                              options['sample'])
+        result['environment'] = {'python': platform.python_version(),
+                                 'numpy': np.__version__,
+                                 'pandas': pd.__version__}
+
+        output = json.dumps(result, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,78 @@
+""" rewrite stored CommonTransaction money fields as integer minor units """
+from bson.int64 import Int64
+from pymongo import UpdateOne
+
+from django.core.management.base import BaseCommand
+
+from r2d2.common_layer.models import CommonTransaction
+import r2d2.common_layer.models as clmodels
+
+
+class Command(BaseCommand):
+    """
+    Rewrites the money fields of existing CommonTransactions from BSON doubles to
+    BSON int64 minor units (see r2d2.common_layer.fields.MoneyField), in bulk.
+
+    Enable settings.COMMON_LAYER_MONEY_AS_MINOR_UNITS before running this so no new
+    doubles are written afterwards.  Documents that are already converted are left
+    untouched, so the command can safely be run again.  --reverse writes doubles back.
+    """
+    help = 'Rewrites CommonTransaction money fields as integer minor units'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                            help='Number of documents rewritten per bulk write')
+        parser.add_argument('--reverse', action='store_true', dest='reverse', default=False,
+                            help='Rewrite integer minor units back to doubles')
+
+    def handle(self, *args, **options):
+        coll = CommonTransaction._get_collection()
+        batch_size = options['batch_size']
+        convert = from_minor_units_to_float if options['reverse'] else to_stored_minor_units
+        money_columns = clmodels.get_money_columns() + clmodels.get_converted_money_columns()
+        transaction_fields = [column for column in money_columns if not column.startswith('product_')]
+        product_fields = [column[len('product_'):] for column in money_columns if column.startswith('product_')]
+
+        requests = []
+        converted = 0
+        for document in coll.find({}, ['products'] + transaction_fields):
+            update = {}
+            for field in transaction_fields:
+                if field in document and convert(document[field]) is not None:
+                    update[field] = convert(document[field])
+
+            products = document.get('products') or []
+            changed = False
+            for product in products:
+                for field in product_fields:
+                    if field in product and convert(product[field]) is not None:
+                        product[field] = convert(product[field])
+                        changed = True
+            if changed:
+                update['products'] = products
+
+            if update:
+                requests.append(UpdateOne({'_id': document['_id']}, {'$set': update}))
+
+            if len(requests) == batch_size:
+                converted += coll.bulk_write(requests, ordered=False).modified_count
+                requests = []
+
+        if requests:
+            converted += coll.bulk_write(requests, ordered=False).modified_count
+
+        self.stdout.write('%d CommonTransactions rewritten' % converted)
+
+
+def to_stored_minor_units(value):
+    """ Returns a stored double as Int64 minor units, or None if it is already converted or missing """
+    if value is None or isinstance(value, Int64):
+        return None
+    return Int64(clmodels.to_minor_units(value))
+
+
+def from_minor_units_to_float(value):
+    """ Returns stored Int64 minor units as a double, or None if it is not in minor units """
+    if not isinstance(value, Int64):
+        return None
+    return float(clmodels.from_minor_units(value))
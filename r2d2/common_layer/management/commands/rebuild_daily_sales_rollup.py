@@ -0,0 +1,25 @@
+""" rebuild the daily sales rollup from stored CommonTransactions """
+from django.core.management.base import BaseCommand
+
+from r2d2.common_layer.rollups import rebuild_daily_sales_rollup
+
+
+class Command(BaseCommand):
+    """
+    Recomputes DailySalesRollup from the stored CommonTransactions, for every user or
+    only the passed one (see r2d2.common_layer.rollups.rebuild_daily_sales_rollup()).
+    Run it while no imports are running:  the rollup of transactions imported
+    meanwhile would be counted twice.
+    """
+    help = 'Rebuilds the daily sales rollup from CommonTransactions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, dest='user_id', default=None,
+                            help='Only rebuild the rollup of this user')
+        parser.add_argument('--batch-size', type=int, dest='batch_size', default=1000,
+                            help='Number of CommonTransactions summed per bulk write')
+
+    def handle(self, *args, **options):
+        count = rebuild_daily_sales_rollup(options['user_id'], options['batch_size'])
+
+        self.stdout.write('%d CommonTransactions rolled up' % count)
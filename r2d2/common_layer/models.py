@@ -1,15 +1,26 @@
 # -*- coding: utf-8 -*-
 """ common layer """
+from bson.int64 import Int64
+from datetime import datetime
 from django_mongoengine import document, fields
 from decimal import Decimal
 from django.db import models
+import logging
 
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
 
+from r2d2.common_layer.fields import MoneyField, money_as_minor_units
 from r2d2.common_layer.signals import object_imported
 from r2d2.common_layer.utils import map_id
 
+logger = logging.getLogger('django')
+
+# Monetary DecimalFields are stored with a precision of 5, so fixed point money
+# columns hold integer multiples of 10 ** -MONEY_PRECISION (minor units)
+MONEY_PRECISION = 5
+
 
 class CommonTransactionProduct(document.EmbeddedDocument):
     """
@@ -20,10 +31,16 @@ class CommonTransactionProduct(document.EmbeddedDocument):
     name = fields.StringField()
     sku = fields.StringField()
     quantity = fields.DecimalField(precision=10)
-    price = fields.DecimalField(precision=5, required=True)
-    tax = fields.DecimalField(precision=5, null=True, blank=True)
-    discount = fields.DecimalField(precision=5, null=True, blank=True)
-    total = fields.DecimalField(precision=5)
+    price = MoneyField(precision=5, required=True)
+    tax = MoneyField(precision=5, null=True, blank=True)
+    discount = MoneyField(precision=5, null=True, blank=True)
+    total = MoneyField(precision=5)
+
+    # amounts converted to the transaction's reporting_currency at import
+    price_converted = MoneyField(precision=5, null=True, blank=True)
+    tax_converted = MoneyField(precision=5, null=True, blank=True)
+    discount_converted = MoneyField(precision=5, null=True, blank=True)
+    total_converted = MoneyField(precision=5, null=True, blank=True)
 
 
 class CommonTransaction(document.Document):
@@ -36,10 +53,10 @@ class CommonTransaction(document.Document):
     transaction_id = fields.StringField(db_index=True, unique=True)
     date = fields.DateTimeField(db_index=True)
     products = fields.ListField(fields.EmbeddedDocumentField('CommonTransactionProduct'))
-    total_price = fields.DecimalField(precision=5)
-    total_tax = fields.DecimalField(precision=5)
-    total_discount = fields.DecimalField(precision=5)
-    total_total = fields.DecimalField(precision=5)
+    total_price = MoneyField(precision=5)
+    total_tax = MoneyField(precision=5)
+    total_discount = MoneyField(precision=5)
+    total_total = MoneyField(precision=5)
     currency_code = fields.StringField()
     source = fields.StringField()
 
@@ -48,6 +65,25 @@ class CommonTransaction(document.Document):
     data_provider_name = fields.StringField()
     data_provider_id = fields.IntField()
 
+    # The amounts converted to reporting_currency at import, with the exchange rate of the
+    # transaction's day (see r2d2.common_layer.currency.store_converted_amounts()).  Unset
+    # if there was no rate for that day yet
+    reporting_currency = fields.StringField()
+    exchange_rate = fields.DecimalField(precision=10, force_string=True, null=True)
+    total_price_converted = MoneyField(precision=5, null=True)
+    total_tax_converted = MoneyField(precision=5, null=True)
+    total_discount_converted = MoneyField(precision=5, null=True)
+    total_total_converted = MoneyField(precision=5, null=True)
+    # The currency and r2d2.common_layer.currency.exchange_rates_version() the amounts were
+    # last converted (or failed to be converted) with, so that the backfill only retries
+    # transactions once the rates change
+    rates_version = fields.StringField()
+
+    # When the transaction was last imported (naive UTC).  Not a column of
+    # CommonTransactionDataFrame:  snapshots are refreshed from it (see
+    # r2d2.common_layer.snapshots)
+    updated_at = fields.DateTimeField(db_index=True)
+
 
 class CommonTransactionDataFrame():
     """
@@ -69,19 +105,244 @@ class CommonTransactionDataFrame():
               'data_provider_id',
               'data_provider_name']
 
+    # CommonTransactionProduct members, flattened with a 'product_' prefix
+    _products = ['name',
+                 'sku',
+                 'quantity',
+                 'price',
+                 'tax',
+                 'discount',
+                 'total']
+
+    # The conversion stored at import, only returned by find(converted=True).  The
+    # converted amounts are named as the columns added by convert_common_transactions_df()
+    _converted_metas = ['reporting_currency',
+                        'exchange_rate',
+                        'total_price_converted',
+                        'total_tax_converted',
+                        'total_discount_converted',
+                        'total_total_converted']
+
+    _converted_products = ['price_converted',
+                           'tax_converted',
+                           'discount_converted',
+                           'total_converted']
+
+    @classmethod
+    def get_columns(cls):
+        """
+        Returns the list of flattened column names, in the order find() returns them
+        """
+        return ['product_' + product for product in cls._products] + cls._metas
+
+    @classmethod
+    def get_converted_columns(cls):
+        """
+        Returns the list of flattened column names of the conversion stored at import,
+        in the order find(converted=True) appends them
+        """
+        return ['product_' + product for product in cls._converted_products] + cls._converted_metas
+
     @classmethod
     def find(cls, user_id=None, data_provider_name=None, data_provider_id=None,
-             source=None, start_date=None, end_date=None, transaction_id=None):
+             source=None, start_date=None, end_date=None, transaction_id=None, columns=None,
+             chunksize=None, fixed_point=False, snapshot=False, compact=False, converted=False):
         """
         Access the MongoDB datastore and return a pandas.DataFrame of flattened
         CommonTransaction results with they're child products
+
+        user_id:  a user's ID, or a list of IDs to read the transactions of several users
+            with one query
+        columns:  optional list of flattened column names (see get_columns()) to return.
+            Only the matching fields are requested from MongoDB.  Defaults to all columns
+        chunksize:  if set, returns an iterator that walks the MongoDB cursor and yields
+            one DataFrame per chunksize CommonTransactions instead of a single DataFrame,
+            so that the full history never has to be held in memory at once
+        fixed_point:  if True monetary columns hold int64 minor units (see MONEY_PRECISION)
+            instead of Decimal objects, so they can be aggregated at NumPy speed.  Use
+            from_minor_units() or money_columns_to_decimal() to get Decimals back
+        snapshot:  if True and settings.COMMON_LAYER_SNAPSHOT_ROOT is set, reads the
+            user's (and data provider's) transactions from the local columnar snapshot,
+            fetching only the documents imported since it was written (see
+            r2d2.common_layer.snapshots).  Requires user_id
+        compact:  if True repeated strings are returned as categoricals and IDs as int32
+            (see compact_dtypes())
+        converted:  if True the conversion stored at import (see get_converted_columns())
+            is returned too.  Pass the frame to
+            r2d2.common_layer.currency.convert_stored_common_transactions_df()
         """
+        columns = cls._validate_columns(columns)
+        if converted:
+            columns += [column for column in cls.get_converted_columns() if column not in columns]
+
+        if snapshot:
+            from r2d2.common_layer.snapshots import TransactionSnapshot, get_snapshot_root
+            if get_snapshot_root():
+                if user_id is None:
+                    raise ValueError('CommonTransactionDataFrame snapshots require a user_id')
+                if chunksize:
+                    raise ValueError('CommonTransactionDataFrame snapshots cannot be read in chunks')
+                txns_snapshot = TransactionSnapshot(user_id, data_provider_name, data_provider_id)
+                txnsDF = txns_snapshot.find(source=source, start_date=start_date, end_date=end_date,
+                                            transaction_id=transaction_id, columns=columns,
+                                            fixed_point=fixed_point)
+                if txnsDF is not None:  # otherwise the snapshot couldn't be written:  read MongoDB
+                    return compact_dtypes(txnsDF) if compact else txnsDF
+
         # Get the collection this way to take advantage of mongoengine's underlying
         # connection management
         coll = CommonTransaction._get_collection()
 
+        find_dict = cls._query(user_id, data_provider_name, data_provider_id, source, start_date, end_date,
+                               transaction_id)
+        cursor = coll.find(find_dict, cls._projection(columns))
+
+        if chunksize:
+            return cls._iter_df(cursor.batch_size(chunksize), columns, chunksize, fixed_point, compact)
+
+        return cls._to_df(cursor, columns, fixed_point, compact)
+
+    @classmethod
+    def aggregate(cls, user_id=None, data_provider_name=None, data_provider_id=None,
+                  source=None, start_date=None, end_date=None, by_product=False, by_hour=False,
+                  fixed_point=False):
+        """
+        Sums the matching CommonTransactionProducts in MongoDB with an aggregation
+        pipeline and returns a pandas.DataFrame with one row per day (or hour if by_hour),
+        currency, data provider and, if by_product, product.
+
+        Rows have the same columns as the line items returned by find() (date,
+        currency_code, source, data_provider_name, data_provider_id, product_name,
+        product_sku, product_quantity, product_price, product_tax, product_discount and
+        product_total), plus a count of the line items summed.  date is the start of
+        the day (or hour).  Since exchange rates are daily the frame can be passed to
+        r2d2.common_layer.currency.convert_common_transactions_df(), and then to any
+        aggregation that sums these columns by period, channel or product, in place of
+        the full list of line items.  Periods must be made of whole days (or hours):  the
+        '7 days', '30 days' and '365 days' periods of salesByPeriod() are anchored on the
+        time of the first transaction, so can't be computed from these rows.
+
+        The monetary sums are computed by MongoDB, so every matching document must be
+        stored in the same format (see settings.COMMON_LAYER_MONEY_AS_MINOR_UNITS and
+        the convert_money_to_minor_units command)
+        """
+        coll = CommonTransaction._get_collection()
+        find_dict = cls._query(user_id, data_provider_name, data_provider_id, source, start_date, end_date)
+
+        keys = OrderedDict([('year', {'$year': '$date'}),
+                            ('month', {'$month': '$date'}),
+                            ('day', {'$dayOfMonth': '$date'}),
+                            ('currency_code', '$currency_code'),
+                            ('source', '$source'),
+                            ('data_provider_name', '$data_provider_name'),
+                            ('data_provider_id', '$data_provider_id')])
+        if by_hour:
+            keys['hour'] = {'$hour': '$date'}
+        if by_product:
+            keys['product_name'] = '$products.name'
+            keys['product_sku'] = '$products.sku'
+
+        group = {'_id': keys, 'count': {'$sum': 1}}
+        sums = ['quantity', 'price', 'tax', 'discount', 'total']
+        for field in sums:
+            group['product_' + field] = {'$sum': '$products.' + field}
+
+        pipeline = [{'$match': find_dict},
+                    {'$project': {'date': True,
+                                  'currency_code': True,
+                                  'source': True,
+                                  'data_provider_name': True,
+                                  'data_provider_id': True,
+                                  'products': True}},
+                    {'$unwind': '$products'},
+                    {'$group': group}]
+        results = list(coll.aggregate(pipeline, allowDiskUse=True))
+
+        key_columns = ['date'] + [key for key in keys.keys() if key not in ['year', 'month', 'day', 'hour']]
+        columns = key_columns + ['product_' + field for field in sums] + ['count']
+        if len(results) == 0:
+            return pd.DataFrame(columns=columns)
+
+        data = dict((column, []) for column in columns)
+        for result in results:
+            key = result['_id']
+            data['date'].append(datetime(key['year'], key['month'], key['day'], key.get('hour', 0)))
+            for column in key_columns[1:]:
+                data[column].append(key.get(column))
+            for column in columns[len(key_columns):]:
+                data[column].append(result[column])
+
+        for column in get_money_columns():
+            if column in data:
+                if money_as_minor_units():
+                    data[column] = np.array(data[column], dtype=np.int64)
+                else:
+                    data[column] = minor_units_array(data[column])
+
+        txnsDF = pd.DataFrame(data, columns=columns)
+        txnsDF = txnsDF.sort_values(by=key_columns).reset_index(drop=True)
+        if not fixed_point:
+            txnsDF = money_columns_to_decimal(txnsDF)
+
+        return txnsDF
+
+    @classmethod
+    def quantity_modes(cls, user_id=None, data_provider_name=None, data_provider_id=None,
+                       source=None, start_date=None, end_date=None):
+        """
+        Returns a pandas.DataFrame with, for each product_name, the most frequent quantity
+        bought per transaction (product_quantity) and how many transactions bought it
+        (count).  Quantities of the same product listed more than once in a transaction
+        are summed first.  The same as r2d2.insights.generators.mode() applied to the
+        line items, computed by a MongoDB aggregation pipeline
+        """
+        coll = CommonTransaction._get_collection()
+        find_dict = cls._query(user_id, data_provider_name, data_provider_id, source, start_date, end_date)
+
+        pipeline = [{'$match': find_dict},
+                    {'$project': {'transaction_id': True, 'products': True}},
+                    {'$unwind': '$products'},
+                    {'$group': {'_id': {'transaction_id': '$transaction_id', 'product_name': '$products.name'},
+                                'product_quantity': {'$sum': '$products.quantity'}}},
+                    {'$group': {'_id': {'product_name': '$_id.product_name', 'product_quantity': '$product_quantity'},
+                                'count': {'$sum': 1}}},
+                    {'$sort': OrderedDict([('count', -1), ('_id.product_quantity', 1)])},
+                    {'$group': {'_id': '$_id.product_name',
+                                'product_quantity': {'$first': '$_id.product_quantity'},
+                                'count': {'$first': '$count'}}}]
+        results = list(coll.aggregate(pipeline, allowDiskUse=True))
+
+        columns = ['product_name', 'product_quantity', 'count']
+        if len(results) == 0:
+            return pd.DataFrame(columns=columns)
+
+        txnsDF = pd.DataFrame([(result['_id'], result['product_quantity'], result['count']) for result in results],
+                              columns=columns)
+        return txnsDF.sort_values(by=['count', 'product_name'], ascending=[False, True]).reset_index(drop=True)
+
+    @classmethod
+    def exists(cls, user_id=None, data_provider_name=None, data_provider_id=None, source=None, start_date=None,
+               end_date=None):
+        """
+        Returns whether any matching CommonTransaction has products, i.e. whether find()
+        would return any rows, reading a single document id from MongoDB
+        """
+        coll = CommonTransaction._get_collection()
+        find_dict = cls._query(user_id, data_provider_name, data_provider_id, source, start_date, end_date)
+        find_dict['products.0'] = {'$exists': True}
+
+        return coll.find_one(find_dict, {'_id': True}) is not None
+
+    @classmethod
+    def _query(cls, user_id=None, data_provider_name=None, data_provider_id=None, source=None,
+               start_date=None, end_date=None, transaction_id=None):
+        """
+        Returns the MongoDB query for the passed filters
+        """
         find_dict = OrderedDict()  # order matters for MongoDB indexes
-        if user_id:
+        if isinstance(user_id, (list, tuple, set)):
+            find_dict['user_id'] = {'$in': list(user_id)}
+        elif user_id:
             find_dict['user_id'] = user_id
         if data_provider_name:
             find_dict['data_provider_name'] = data_provider_name
@@ -100,28 +361,119 @@ class CommonTransactionDataFrame():
                 date_dict['$lte'] = end_date
             find_dict['date'] = date_dict
 
-        results = list(coll.find(find_dict))
+        return find_dict
+
+    @classmethod
+    def _iter_df(cls, cursor, columns, chunksize, fixed_point=False, compact=False):
+        """
+        Generator of flattened DataFrames built from every chunksize documents of the
+        cursor.  Chunks without any products are skipped
+        """
+        documents = []
+        for doc in cursor:
+            documents.append(doc)
+            if len(documents) == chunksize:
+                txnsDF = cls._to_df(documents, columns, fixed_point, compact)
+                documents = []
+                if txnsDF.shape[0] != 0:
+                    yield txnsDF
+
+        if documents:
+            txnsDF = cls._to_df(documents, columns, fixed_point, compact)
+            if txnsDF.shape[0] != 0:
+                yield txnsDF
 
-        txnsDF = pd.io.json.json_normalize(results, 'products', cls._metas, record_prefix='product_')
+    @classmethod
+    def _validate_columns(cls, columns):
+        """
+        Returns the passed columns, or all columns if None.  Raises ValueError for
+        unknown columns
+        """
+        all_columns = cls.get_columns()
+        if columns is None:
+            return all_columns
+        all_columns += cls.get_converted_columns()
 
-        # Apply our own data types to monetary columns and the user_id.  This
-        # adds significant time (4x) to the function processing, but seems necessary
-        # because we're side stepping mongoengine's handling of the float to Decimal
-        # conversion.  Upgrading to MongoDB 3.4 might allow this code to be removed
-        # because that version supports a decimal BSON type.
-        # Note that we first convert float columns to strings, then to Decimal,
-        # because going directly to Decimal from float was introducing binary rounding
-        # errors.
-        # TODO:  read comment and adjust/remove astype,apply calls as needed
+        unknown = [column for column in columns if column not in all_columns]
+        if unknown:
+            raise ValueError('Unknown CommonTransactionDataFrame columns: %s' % ', '.join(unknown))
 
-        # no results
-        if txnsDF.shape[0] == 0:
-            return txnsDF
+        return list(columns)
 
-        for col in get_money_columns():
-            txnsDF[col] = txnsDF[col].astype(str)
-            txnsDF[col] = txnsDF[col].apply(Decimal)
-        txnsDF.user_id = txnsDF.user_id.apply(int)
+    @classmethod
+    def _projection(cls, columns):
+        """
+        Returns the MongoDB projection that fetches only the fields needed for columns.
+        products is always projected, as each product makes up one row of the DataFrame
+        """
+        projection = {'_id': '_id' in columns}
+        for column in columns:
+            if not column.startswith('product_') and column != '_id':
+                projection[column] = True
+
+        products = [column[len('product_'):] for column in columns if column.startswith('product_')]
+        if set(cls._products).issubset(products):
+            projection['products'] = True
+        else:
+            for product in products or ['name']:
+                projection['products.' + product] = True
+
+        return projection
+
+    @classmethod
+    def _flatten(cls, documents, columns):
+        """
+        Flattens an iterable of raw CommonTransaction documents in a single pass into a
+        dict of one list per column, holding one entry per product.  Documents without
+        products are skipped
+        """
+        product_columns = [(column, column[len('product_'):]) for column in columns if column.startswith('product_')]
+        meta_columns = [column for column in columns if not column.startswith('product_')]
+        data = dict((column, []) for column in columns)
+
+        for doc in documents:
+            products = doc.get('products') or []
+            count = len(products)
+            if count == 0:
+                continue
+
+            for (column, field) in product_columns:
+                data[column].extend([product.get(field) for product in products])
+            for column in meta_columns:
+                data[column].extend([doc.get(column)] * count)
+
+        return data
+
+    @classmethod
+    def _to_df(cls, documents, columns, fixed_point=False, compact=False):
+        """
+        Flattens an iterable of raw CommonTransaction documents into a DataFrame in a
+        single pass, one list per column, then decodes the monetary columns
+        """
+        data = cls._flatten(documents, columns)
+
+        # no results
+        if len(data[columns[0]]) == 0:
+            return pd.DataFrame(columns=columns)
+
+        # We side step mongoengine's handling of MoneyField conversion, so monetary
+        # columns are decoded here.  Each distinct stored value is converted once and
+        # broadcast back over the column rather than converting every cell.
+        for column in get_money_columns() + get_converted_money_columns():
+            if column in data:
+                if fixed_point:
+                    data[column] = minor_units_array(data[column])
+                else:
+                    data[column] = decimal_array(data[column])
+        if 'exchange_rate' in data:
+            data['exchange_rate'] = decimal_array(data['exchange_rate'])
+
+        txnsDF = pd.DataFrame(data, columns=columns)
+        if 'user_id' in txnsDF:
+            txnsDF.user_id = txnsDF.user_id.astype(np.int64)
+
+        if compact:
+            txnsDF = compact_dtypes(txnsDF)
 
         return txnsDF
 
@@ -157,76 +509,9 @@ class ExchangeRate(models.Model):
         db_table = 'djmoney_rates_rate'
 
 
-def unpack(txn):
-    """
-    Returns a flattened CommonTransaction with its CommonTransactionProducts
-    as a list of tuples (using zip())
-    """
-
-    user_ids = []
-    transaction_ids = []
-    dates = []
-    total_prices = []
-    total_taxs = []
-    total_discounts = []
-    total_totals = []
-    currency_codes = []
-    sources = []
-    data_provider_name = []
-    data_provider_id = []
-    product_name = []
-    product_sku = []
-    product_quantity = []
-    product_price = []
-    product_tax = []
-    product_discount = []
-    product_total = []
-
-    for product in txn.products:
-        user_ids.append(txn.user_id)
-        transaction_ids.append(txn.transaction_id)
-        dates.append(txn.date)
-        total_prices.append(txn.total_price)
-        total_taxs.append(txn.total_tax)
-        total_discounts.append(txn.total_discount)
-        total_totals.append(txn.total_total)
-        currency_codes.append(txn.currency_code)
-        sources.append(txn.source)
-        data_provider_name.append(txn.data_provider_name)
-        data_provider_id.append(txn.data_provider_id)
-        product_name.append(product.name)
-        product_sku.append(product.sku)
-        product_quantity.append(product.quantity)
-        product_price.append(product.price)
-        product_tax.append(product.tax)
-        product_discount.append(product.discount)
-        product_total.append(product.total)
-
-    zipped = zip(user_ids,
-                 transaction_ids,
-                 dates,
-                 total_prices,
-                 total_taxs,
-                 total_discounts,
-                 total_totals,
-                 currency_codes,
-                 sources,
-                 data_provider_name,
-                 data_provider_id,
-                 product_name,
-                 product_sku,
-                 product_quantity,
-                 product_price,
-                 product_tax,
-                 product_discount,
-                 product_total)
-
-    return zipped
-
-
 def get_unpack_columns():
     """
-    Returns a tuple of column names that correspond to the tuples returned by unpack
+    Returns a tuple of the column names of the DataFrame returned by common_transactions_to_df()
     """
     return(('user_id',
             'transaction_id',
@@ -264,35 +549,221 @@ def get_money_columns():
             'product_total'])
 
 
-def common_transactions_to_df(common_transactions):
+def get_converted_money_columns():
+    """
+    Returns a list of the columns holding monetary fields converted to the reporting
+    currency, as added by r2d2.common_layer.currency.convert_common_transactions_df()
+    and stored at import
+    """
+    return [column + '_converted' for column in get_money_columns()]
+
+
+def get_categorical_columns():
+    """
+    Returns a list of the string columns that repeat the same values across line items
+    """
+    return(['transaction_id',
+            'currency_code',
+            'source',
+            'data_provider_name',
+            'product_name',
+            'product_sku'])
+
+
+def compact_dtypes(df):
+    """
+    Converts the passed flattened CommonTransaction DataFrame to a more compact memory
+    layout, in place, and returns it:
+    - the columns of get_categorical_columns() become categoricals
+    - user_id and data_provider_id become int32, unless they have missing values
+    - date becomes datetime64
+
+    The memory used before and after is logged.  Note that with pandas 0.18 grouping by
+    a single categorical column returns every category, even those not in the frame
+    anymore, and merging converts categoricals back to objects.
+    """
+    if df is None or df.shape[0] == 0:
+        return df
+
+    before = df.memory_usage(deep=True).sum()
+
+    for column in get_categorical_columns():
+        if column in df and df[column].dtype == object:
+            df[column] = df[column].astype('category')
+    for column in ['user_id', 'data_provider_id']:
+        if column in df and df[column].dtype.kind in 'iu':
+            df[column] = df[column].astype(np.int32)
+    if 'date' in df and df.date.dtype == object:
+        df['date'] = pd.to_datetime(df.date)
+
+    logger.info("CommonTransactionDataFrame compacted from %(before)d to %(after)d bytes" %
+                {'before': before, 'after': df.memory_usage(deep=True).sum()})
+
+    return df
+
+
+def decimal_array(values):
+    """
+    Converts a list of monetary values as stored in MongoDB to an object array of
+    Decimal.  Missing values become Decimal('NaN').
+
+    Values stored as integer minor units (see MoneyField) are scaled directly.  Values
+    stored as BSON doubles are converted to strings, then to Decimal, because going
+    directly to Decimal from float introduces binary rounding errors.
+    """
+    return _decode_money(values, from_minor_units, lambda value: Decimal(str(value)), Decimal('NaN'), object)
+
+
+def minor_units_array(values):
+    """
+    Converts a list of monetary values (as stored in MongoDB, or Decimals) to an int64
+    array of minor units.  Missing values become 0
+    """
+    return _decode_money(values, int, to_minor_units, 0, np.int64)
+
+
+def _decode_money(values, from_minor, from_other, missing, dtype):
+    """
+    Decodes stored monetary values into an array of dtype.  Integer minor units
+    (BSON int64) are passed to from_minor, anything else to from_other.  Only the
+    distinct values are converted, since prices and totals repeat heavily across
+    line items.  The two representations are decoded separately, as equal numbers
+    mean different amounts in each.
+    """
+    values = np.asarray(values, dtype=object)
+    is_minor = np.fromiter((isinstance(value, Int64) for value in values), dtype=bool, count=len(values))
+
+    decoded = np.empty(len(values), dtype=dtype)
+    decoded[is_minor] = _map_distinct(values[is_minor], from_minor, missing, dtype)
+    decoded[~is_minor] = _map_distinct(values[~is_minor], from_other, missing, dtype)
+
+    return decoded
+
+
+def _map_distinct(values, convert, missing, dtype):
+    """
+    Applies convert to each distinct non-null value and broadcasts the results back
+    over the array.  Null values are mapped to missing
+    """
+    (codes, uniques) = pd.factorize(values)
+    lookup = [convert(unique) for unique in uniques]
+    lookup.append(missing)  # factorize codes missing values as -1
+
+    return np.array(lookup, dtype=dtype)[codes]
+
+
+def to_minor_units(value):
+    """
+    Returns the passed monetary value (float, Decimal or None) as an integer number
+    of minor units.  Missing values are returned as 0
+    """
+    if value is None or value != value:  # None or NaN
+        return 0
+
+    return int(Decimal(str(value)).scaleb(MONEY_PRECISION).to_integral_value())
+
+
+def from_minor_units(value):
+    """
+    Returns the passed integer number of minor units as a Decimal
+    """
+    return Decimal(int(value)).scaleb(-MONEY_PRECISION)
+
+
+def money_columns_to_decimal(df):
+    """
+    Converts the fixed point monetary columns of the passed DataFrame, including
+    their _converted counterparts, back to Decimal.  Intended to be called on
+    aggregated results right before they are formatted for display.  Converted columns
+    are float64 when some rows had no exchange rate:  their NaN become Decimal NaN.
+    """
+    for column in get_money_columns():
+        for name in [column, column + '_converted']:
+            if name in df and df[name].dtype.kind in ('i', 'f'):
+                (codes, uniques) = pd.factorize(df[name].values)
+                lookup = [from_minor_units(unique) for unique in uniques] + [Decimal('NaN')]  # code -1 is NaN
+                df[name] = np.array(lookup, dtype=object)[codes]
+
+    return df
+
+
+def common_transactions_to_df(common_transactions, fixed_point=False):
     '''
     Turns a list of CommonTransaction objects into a DataFrame, flattening
     out the CommonTransactionProduct children in the process.  Returns None
     if the passed iterator is empty
+
+    Rows are written straight into one preallocated array per column (see
+    get_unpack_columns()), sized from the total number of products, rather than
+    going through per-row tuples.  date and the integer ID columns get typed arrays;
+    the other columns hold Python objects (strings and Decimals) either way.
+
+    fixed_point:  if True monetary columns hold int64 minor units instead of Decimal
     '''
     if len(common_transactions) == 0:
         return(None)
 
-    txnList = []
-    for txn in common_transactions:
-        txnList.extend(unpack(txn))
+    columns = get_unpack_columns()
+    product_columns = [column for column in columns if column.startswith('product_')]
+    meta_columns = [column for column in columns if not column.startswith('product_')]
+    int_columns = ['user_id', 'data_provider_id']
 
-    retDF = pd.DataFrame(txnList)
-    retDF.columns = get_unpack_columns()
-    retDF['date'] = pd.to_datetime(retDF['date'])  # allows for fast date searching/indexing
+    rows = sum(len(txn.products) for txn in common_transactions)
+    data = dict((column, np.empty(rows, dtype=object)) for column in columns)
+    data['date'] = np.empty(rows, dtype='datetime64[ns]')
+    missing = {}
+    for column in int_columns:
+        data[column] = np.zeros(rows, dtype=np.int64)
+        missing[column] = np.zeros(rows, dtype=bool)
 
-    return retDF
+    start = 0
+    for txn in common_transactions:
+        end = start + len(txn.products)
+        if end == start:
+            continue
+
+        for column in meta_columns:
+            value = getattr(txn, column)
+            if value is None and column in missing:
+                missing[column][start:end] = True
+            else:
+                data[column][start:end] = np.datetime64('NaT') if value is None and column == 'date' else value
+        for column in product_columns:
+            field = column[len('product_'):]
+            values = data[column]
+            for (i, product) in enumerate(txn.products, start):
+                values[i] = getattr(product, field)
+        start = end
+
+    # missing IDs are NaN, as pandas does for integer columns with missing values
+    for column in int_columns:
+        if missing[column].any():
+            data[column] = data[column].astype(float)
+            data[column][missing[column]] = np.nan
+
+    if fixed_point:
+        for column in get_money_columns():
+            data[column] = minor_units_array(data[column])
+
+    return pd.DataFrame(data, columns=columns)
 
 
 def object_imported_handler(**kwargs):
+    from r2d2.common_layer.currency import store_converted_amounts
+    from r2d2.common_layer.rollups import update_daily_sales_rollup
     importer_account = kwargs['importer_account']
     mapped_data = kwargs['mapped_data']
     transaction_id = map_id(importer_account, mapped_data.pop('transaction_id'))
+    previous = CommonTransaction._get_collection().find_one({'transaction_id': transaction_id})
     CommonTransaction.objects.filter(transaction_id=transaction_id).delete()
-    CommonTransaction.objects.create(transaction_id=transaction_id,
-                                     source=importer_account.official_channel_name,
-                                     data_provider_name=importer_account.__class__.__name__,
-                                     data_provider_id=importer_account.id,
-                                     **mapped_data)
+    txn = CommonTransaction(transaction_id=transaction_id,
+                            source=importer_account.official_channel_name,
+                            data_provider_name=importer_account.__class__.__name__,
+                            data_provider_id=importer_account.id,
+                            updated_at=datetime.utcnow(),
+                            **mapped_data)
+    store_converted_amounts(txn)
+    txn.save()
+    update_daily_sales_rollup(txn.to_mongo(), previous)
 
 object_imported.connect(object_imported_handler)
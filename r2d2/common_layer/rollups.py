@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Daily sales rollup of CommonTransactions, maintained incrementally on import.
+
+Each DailySalesRollup document sums the products sold by a data provider on one (UTC)
+day, for one product and currency.  object_imported_handler applies the difference
+between the previous and the new version of every imported CommonTransaction, so the
+rollup never has to be recomputed from the full history.  Transactions without a date
+aren't rolled up.  Run the rebuild_daily_sales_rollup command once, while no imports
+are running, to populate it for existing transactions.
+"""
+from collections import OrderedDict
+from datetime import datetime
+
+from bson.int64 import Int64
+from django.utils import timezone
+from django_mongoengine import document, fields
+import numpy as np
+import pandas as pd
+from pymongo import DeleteOne, UpdateOne
+
+from r2d2.common_layer.models import CommonTransaction, minor_units_array, money_columns_to_decimal
+
+# fields identifying a rollup document, in index order
+ROLLUP_KEYS = ['user_id',
+               'data_provider_name',
+               'data_provider_id',
+               'day',
+               'product_name',
+               'product_sku',
+               'currency_code']
+
+# CommonTransaction fields read to compute the rollup
+TRANSACTION_FIELDS = ['user_id', 'data_provider_name', 'data_provider_id', 'date', 'currency_code', 'products']
+
+
+class DailySalesRollup(document.Document):
+    """
+    The products sold by a data provider on one day, for one product and currency.
+    Monetary sums are stored as integer minor units (see MONEY_PRECISION).
+    transaction_count is the number of line items of the product, as
+    AverageTransactionsPerPeriodInsight counts transactions:  a transaction listing the
+    product twice counts twice.
+    """
+    user_id = fields.IntField()
+    data_provider_name = fields.StringField()
+    data_provider_id = fields.IntField()
+    day = fields.DateTimeField()
+    product_name = fields.StringField()
+    product_sku = fields.StringField()
+    currency_code = fields.StringField()
+    quantity = fields.FloatField()
+    total = fields.LongField()
+    discount = fields.LongField()
+    transaction_count = fields.IntField()
+
+    meta = {'indexes': [{'fields': ROLLUP_KEYS, 'unique': True}]}
+
+
+def update_daily_sales_rollup(txn=None, previous=None):
+    """
+    Updates the rollup for a CommonTransaction that was imported, re-imported or
+    removed.  Both arguments are raw CommonTransaction documents (as stored in MongoDB):
+
+    txn:  the new version of the transaction, or None if it was removed
+    previous:  the version it replaces, or None if it is new
+    """
+    deltas = OrderedDict()
+    add_rollup_deltas(deltas, previous, -1)
+    add_rollup_deltas(deltas, txn, 1)
+    apply_rollup_deltas(deltas)
+
+
+def rebuild_daily_sales_rollup(user_id=None, batch_size=1000):
+    """
+    Recomputes DailySalesRollup from the stored CommonTransactions, for every user or
+    only the passed one.  Returns the number of CommonTransactions rolled up.
+
+    Imports running meanwhile are counted twice, so run it while none are
+    """
+    find_dict = {}
+    if user_id is not None:
+        find_dict['user_id'] = user_id
+
+    DailySalesRollup._get_collection().delete_many(find_dict)
+
+    deltas = OrderedDict()
+    count = 0
+    for txn in CommonTransaction._get_collection().find(find_dict, TRANSACTION_FIELDS):
+        add_rollup_deltas(deltas, txn)
+        count += 1
+        if count % batch_size == 0:
+            apply_rollup_deltas(deltas)
+            deltas = OrderedDict()
+
+    apply_rollup_deltas(deltas)
+    return count
+
+
+def add_rollup_deltas(deltas, txn, sign=1):
+    """
+    Adds (sign=1) or subtracts (sign=-1) the passed raw CommonTransaction's
+    contribution to the rollup to deltas, a dict of
+    [quantity, total, discount, transaction_count] by rollup key
+    """
+    for (key, (quantity, total, discount, count)) in transaction_rollup(txn).items():
+        delta = deltas.setdefault(key, [0, 0, 0, 0])
+        delta[0] += sign * quantity
+        delta[1] += sign * total
+        delta[2] += sign * discount
+        delta[3] += sign * count
+
+
+def apply_rollup_deltas(deltas):
+    """
+    Increments the DailySalesRollup documents by the passed deltas (see
+    add_rollup_deltas()), creating missing ones, in a single bulk write.  Documents
+    left without transactions are removed
+    """
+    requests = []
+    removals = []
+    for (key, (quantity, total, discount, count)) in deltas.items():
+        if (quantity, total, discount, count) == (0, 0, 0, 0):  # unchanged by a re-import
+            continue
+        requests.append(UpdateOne(dict(zip(ROLLUP_KEYS, key)),
+                                  {'$inc': {'quantity': quantity,
+                                            'total': Int64(total),
+                                            'discount': Int64(discount),
+                                            'transaction_count': count}},
+                                  upsert=True))
+        if count < 0:
+            removal = dict(zip(ROLLUP_KEYS, key))
+            removal['transaction_count'] = {'$lte': 0}
+            removals.append(DeleteOne(removal))
+
+    if len(requests) != 0:
+        DailySalesRollup._get_collection().bulk_write(requests + removals, ordered=len(removals) != 0)
+
+
+def transaction_rollup(txn):
+    """
+    Returns an OrderedDict of the passed raw CommonTransaction's contribution to the
+    rollup:  (quantity, total, discount, line item count) summed by rollup key.  Returns an empty
+    OrderedDict for None and for transactions without a date
+    """
+    rollup = OrderedDict()
+    if txn is None or txn.get('date') is None:
+        return rollup
+
+    products = txn.get('products') or []
+    totals = minor_units_array([product.get('total') for product in products])
+    discounts = minor_units_array([product.get('discount') for product in products])
+    day = utc_day(txn.get('date'))
+
+    for (product, total, discount) in zip(products, totals, discounts):
+        key = (txn.get('user_id'),
+               txn.get('data_provider_name'),
+               txn.get('data_provider_id'),
+               day,
+               product.get('name'),
+               product.get('sku'),
+               txn.get('currency_code'))
+        sums = rollup.setdefault(key, [0.0, 0, 0, 0])
+        sums[0] += float(product.get('quantity') or 0)
+        sums[1] += int(total)
+        sums[2] += int(discount)
+        sums[3] += 1
+
+    return rollup
+
+
+def utc_day(date):
+    """ Returns midnight of the passed datetime's day, in naive UTC as stored by MongoDB, or None for None """
+    if date is None:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return datetime(date.year, date.month, date.day)
+
+
+def daily_sales_rollup_df(user_id, data_provider_name=None, data_provider_id=None,
+                          start_date=None, end_date=None, fixed_point=False):
+    """
+    Returns a pandas.DataFrame of the user's DailySalesRollup, with the columns named
+    as in CommonTransactionDataFrame.find() so it can be passed to
+    r2d2.common_layer.currency.convert_common_transactions_df() and to aggregations by
+    calendar period, channel or product:  user_id, date, currency_code,
+    data_provider_name, data_provider_id, product_name, product_sku, product_quantity,
+    product_total, product_discount and transaction_count.
+
+    user_id:  a user's ID, or a list of IDs to read the rollups of several users with
+        one query
+    fixed_point:  if True monetary columns hold int64 minor units instead of Decimal
+    """
+    find_dict = OrderedDict()
+    if isinstance(user_id, (list, tuple, set)):
+        find_dict['user_id'] = {'$in': list(user_id)}
+    else:
+        find_dict['user_id'] = user_id
+    if data_provider_name:
+        find_dict['data_provider_name'] = data_provider_name
+    if data_provider_id:
+        find_dict['data_provider_id'] = data_provider_id
+    if start_date or end_date:
+        date_dict = {}
+        if start_date:
+            date_dict['$gte'] = utc_day(start_date)
+        if end_date:
+            date_dict['$lte'] = end_date
+        find_dict['day'] = date_dict
+
+    columns = OrderedDict([('user_id', 'user_id'),
+                           ('day', 'date'),
+                           ('currency_code', 'currency_code'),
+                           ('data_provider_name', 'data_provider_name'),
+                           ('data_provider_id', 'data_provider_id'),
+                           ('product_name', 'product_name'),
+                           ('product_sku', 'product_sku'),
+                           ('quantity', 'product_quantity'),
+                           ('total', 'product_total'),
+                           ('discount', 'product_discount'),
+                           ('transaction_count', 'transaction_count')])
+
+    coll = DailySalesRollup._get_collection()
+    data = dict((column, []) for column in columns.values())
+    for rollup in coll.find(find_dict, dict((field, True) for field in columns.keys())):
+        for (field, column) in columns.items():
+            data[column].append(rollup.get(field))
+
+    if len(data['date']) == 0:
+        return pd.DataFrame(columns=columns.values())
+
+    data['product_total'] = np.array(data['product_total'], dtype=np.int64)
+    data['product_discount'] = np.array(data['product_discount'], dtype=np.int64)
+
+    rollupDF = pd.DataFrame(data, columns=columns.values())
+    rollupDF = rollupDF.sort_values(by=['date', 'product_name', 'product_sku']).reset_index(drop=True)
+    if not fixed_point:
+        rollupDF = money_columns_to_decimal(rollupDF)
+
+    return rollupDF
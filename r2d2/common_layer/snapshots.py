@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Local disk snapshots of flattened CommonTransactions.
+
+A snapshot holds every flattened transaction of a user (optionally restricted to one data
+provider) as one .npy file per column, so that it can be memory mapped back instead of
+re-reading the whole history from MongoDB:
+    - monetary columns as int64 minor units (see MONEY_PRECISION), along with a boolean
+      array of missing values
+    - user_id as int64 and date as datetime64[ns]
+    - every other column as int32 codes into a (small) array of distinct values
+
+Snapshots are keyed by a watermark:  the latest updated_at (set by object_imported_handler
+on every import) of the CommonTransactions they contain.  Refreshing a snapshot only
+fetches the documents updated since, and appends them, replacing the rows of any
+transaction they supersede.  Since updated_at is set before the document is written, the
+fetch goes back COMMON_LAYER_SNAPSHOT_SETTLE_TIME seconds before the watermark, so that
+documents written late are still picked up; the versions the snapshot already holds are
+skipped.  The document count is read after those documents:  if it doesn't match MongoDB
+(e.g. transactions were deleted) the snapshot is rebuilt from scratch.  Transactions
+without products have no rows, so are left out of both.
+
+Each write goes to a new version directory, under a lock on the snapshot's LOCK file, and
+the CURRENT file is then atomically replaced to point to it, so readers never see a
+partially written snapshot.  Version names start with the time they were written, so that
+only the versions older than the one published (except the previous one, which readers
+may still have mapped) are removed.  A snapshot that can't be written or read back is
+treated as missing:  find() returns None, and CommonTransactionDataFrame.find() reads
+MongoDB instead.
+
+Snapshots also hold the conversion stored at import (see
+CommonTransactionDataFrame.get_converted_columns()).  Backfilling it updates documents in
+place, so the backfill removes the snapshots of the users it updated (see
+remove_snapshots()).
+"""
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+
+from r2d2.common_layer.models import CommonTransaction, CommonTransactionDataFrame, get_money_columns
+from r2d2.common_layer.models import decimal_array, get_converted_money_columns, minor_units_array, from_minor_units
+
+logger = logging.getLogger('django')
+
+CURRENT = 'CURRENT'
+LOCK = 'LOCK'
+META = 'meta.json'
+
+
+def get_snapshot_root():
+    """ Returns the directory snapshots are stored in, or None if snapshots are disabled """
+    return getattr(settings, 'COMMON_LAYER_SNAPSHOT_ROOT', None)
+
+
+def get_settle_time():
+    """
+    Returns how long (in seconds) before a snapshot's watermark its refresh looks for
+    documents:  the longest a CommonTransaction may take to be written after its
+    updated_at is set
+    """
+    return getattr(settings, 'COMMON_LAYER_SNAPSHOT_SETTLE_TIME', 60 * 5)
+
+
+def remove_snapshots(user_id, root=None):
+    """
+    Removes every snapshot of the user, so that they are rebuilt when next read.  Needed
+    when their CommonTransactions are updated in place
+    """
+    shutil.rmtree(os.path.join(root or get_snapshot_root(), str(user_id)), ignore_errors=True)
+
+
+def is_missing(value):
+    """ True for None and NaN """
+    return value is None or value != value
+
+
+class TransactionSnapshot(object):
+    """
+    The snapshot of a user's flattened CommonTransactions, optionally restricted to one data
+    provider.  Snapshots always hold every column of CommonTransactionDataFrame, including
+    the conversion stored at import.
+    """
+    def __init__(self, user_id, data_provider_name=None, data_provider_id=None, root=None):
+        self.columns = CommonTransactionDataFrame.get_columns() + CommonTransactionDataFrame.get_converted_columns()
+        self.money_columns = get_money_columns() + get_converted_money_columns()
+
+        # same semantics as CommonTransactionDataFrame.find(), which has no rows for
+        # transactions without products
+        self.query = OrderedDict()
+        self.query['user_id'] = user_id
+        if data_provider_name:
+            self.query['data_provider_name'] = data_provider_name
+        if data_provider_id:
+            self.query['data_provider_id'] = data_provider_id
+        self.query['products.0'] = {'$exists': True}
+
+        self.path = os.path.join(root or get_snapshot_root(),
+                                 str(user_id),
+                                 '%s_%s' % (data_provider_name or 'all', data_provider_id or 'all'))
+
+    def find(self, source=None, start_date=None, end_date=None, transaction_id=None, columns=None,
+             fixed_point=False):
+        """
+        Refreshes the snapshot and returns it as a DataFrame in the same format as
+        CommonTransactionDataFrame.find(), applying the passed filters.  Returns None if
+        the snapshot can't be written or read
+        """
+        columns = columns or self.columns
+        refreshed = self.refresh()
+        if refreshed is None:
+            return None
+
+        (meta, arrays) = refreshed
+
+        keep = np.ones(meta['rows'], dtype=bool)
+        if source:
+            keep &= arrays['source'] == source
+        if transaction_id:
+            keep &= arrays['transaction_id'] == transaction_id
+        if start_date:
+            keep &= arrays['date'] >= self._naive_utc(start_date)
+        if end_date:
+            keep &= arrays['date'] <= self._naive_utc(end_date)
+
+        if not keep.any():
+            return pd.DataFrame(columns=columns)
+
+        data = {}
+        for column in columns:
+            values = np.array(arrays[column][keep])  # copies out of the memory map
+            if column in self.money_columns and not fixed_point:
+                values = self._decimals(values, arrays[column + '_missing'][keep])
+            elif column == 'exchange_rate':
+                values = decimal_array(values)
+            elif values.dtype == object:
+                values = values.tolist()  # let pandas infer the dtype, as find() does
+            data[column] = values
+
+        return pd.DataFrame(data, columns=columns)
+
+    def refresh(self):
+        """
+        Brings the snapshot up to date with MongoDB and returns its (meta, arrays), or
+        None if it can't be written or read.  Only the documents updated since the
+        snapshot was written are fetched
+        """
+        loaded = self.load()
+        if loaded is None:
+            return self.rebuild()
+
+        (meta, arrays) = loaded
+        coll = CommonTransaction._get_collection()
+
+        tail_query = OrderedDict(self.query)
+        if meta['watermark'] is not None:
+            cutoff = pd.Timestamp(meta['watermark']).to_pydatetime() - timedelta(seconds=get_settle_time())
+            tail_query['updated_at'] = {'$gte': cutoff}
+            recent = arrays['updated_at'] >= np.datetime64(cutoff, 'ns')
+        else:  # transactions imported before updated_at was set are already in the snapshot
+            tail_query['updated_at'] = {'$ne': None}
+            recent = np.zeros(meta['rows'], dtype=bool)
+        documents = list(coll.find(tail_query, self._projection()))
+        doc_count = coll.find(self.query).count()
+
+        # skip the versions the snapshot already holds
+        known = set(zip(arrays['transaction_id'][recent], arrays['updated_at'][recent].view(np.int64)))
+        documents = [document for document in documents
+                     if (document.get('transaction_id'), self._updated_at(document)) not in known]
+
+        if len(documents) == 0 and doc_count == meta['doc_count']:
+            return (meta, arrays)
+
+        tail = self._encode(documents)
+        tail_ids = set(document.get('transaction_id') for document in documents)
+        keep = ~np.in1d(arrays['transaction_id'], list(tail_ids))
+        replaced = len(set(arrays['transaction_id'][~keep]))
+
+        if meta['doc_count'] - replaced + len(documents) != doc_count:
+            logger.info("Rebuilding transaction snapshot %s:  document count mismatch" % self.path)
+            return self.rebuild()
+
+        merged = dict((name, np.concatenate([values[keep], tail[name]])) for (name, values) in arrays.items())
+        return self.write(merged, self._watermark(merged), doc_count, meta['version'])
+
+    def rebuild(self):
+        """ Rewrites the snapshot from all of the matching documents in MongoDB """
+        coll = CommonTransaction._get_collection()
+        documents = list(coll.find(self.query, self._projection()))
+        arrays = self._encode(documents)
+        loaded = self.load()
+        return self.write(arrays, self._watermark(arrays), len(documents), loaded[0]['version'] if loaded else None)
+
+    def load(self):
+        """
+        Returns the (meta, arrays) of the current snapshot, or None if there isn't one.
+        Arrays are memory mapped, with the codes of encoded columns already mapped back to
+        their values
+        """
+        try:
+            with open(os.path.join(self.path, CURRENT)) as current:
+                version_path = os.path.join(self.path, current.read().strip())
+            with open(os.path.join(version_path, META)) as meta_file:
+                meta = json.load(meta_file)
+
+            arrays = {}
+            for name in meta['arrays']:
+                arrays[name] = np.load(os.path.join(version_path, name + '.npy'), mmap_mode='r')
+            for name in meta['encoded']:
+                codes = np.load(os.path.join(version_path, name + '_codes.npy'), mmap_mode='r')
+                values = np.load(os.path.join(version_path, name + '_values.npy'))
+                arrays[name] = np.append(values, None)[codes]  # code -1 is a missing value
+        except (IOError, OSError, ValueError):
+            return None
+
+        if any(column not in arrays for column in self.columns + ['updated_at']):  # written before they were added
+            return None
+
+        return (meta, arrays)
+
+    def write(self, arrays, watermark, doc_count, previous_version=None):
+        """
+        Writes the passed arrays as a new version of the snapshot and makes it current.
+        Versions older than the new one, other than the previous one, are removed.
+        Returns (meta, arrays), or None if the snapshot couldn't be written or read back
+        """
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            with open(os.path.join(self.path, LOCK), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self._write(arrays, watermark, doc_count, previous_version)
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+        except (IOError, OSError):
+            logger.exception("Writing transaction snapshot %s failed" % self.path)
+            return None
+
+        return self.load()
+
+    def _write(self, arrays, watermark, doc_count, previous_version=None):
+        """ Writes and publishes a new version of the snapshot, as write(), under its lock """
+        version = '%d-%s' % (int(time.time() * 1000000), uuid.uuid4().hex)
+        version_path = os.path.join(self.path, version)
+        os.makedirs(version_path)
+
+        meta = {'version': version,
+                'watermark': watermark,
+                'doc_count': doc_count,
+                'rows': len(arrays['transaction_id']),
+                'arrays': [],
+                'encoded': []}
+
+        for (name, values) in arrays.items():
+            if values.dtype == object:
+                (codes, uniques) = pd.factorize(values)
+                np.save(os.path.join(version_path, name + '_codes.npy'), codes.astype(np.int32))
+                np.save(os.path.join(version_path, name + '_values.npy'), np.asarray(uniques, dtype=object))
+                meta['encoded'].append(name)
+            else:
+                np.save(os.path.join(version_path, name + '.npy'), values)
+                meta['arrays'].append(name)
+
+        with open(os.path.join(version_path, META), 'w') as meta_file:
+            json.dump(meta, meta_file)
+
+        current_tmp = os.path.join(self.path, '%s.%s' % (CURRENT, version))
+        with open(current_tmp, 'w') as current:
+            current.write(version)
+        os.rename(current_tmp, os.path.join(self.path, CURRENT))
+
+        # readers may still have the previous version mapped
+        for name in os.listdir(self.path):
+            if name in (version, previous_version, CURRENT, LOCK) or name.startswith(CURRENT):
+                continue
+            if self._version_time(name) < self._version_time(version):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def _projection(self):
+        """ Returns the MongoDB projection of the fields stored in the snapshot """
+        projection = CommonTransactionDataFrame._projection(self.columns)
+        projection['updated_at'] = True
+        return projection
+
+    def _encode(self, documents):
+        """
+        Flattens raw CommonTransaction documents into the arrays stored in a snapshot,
+        along with the updated_at of each row's transaction
+        """
+        data = CommonTransactionDataFrame._flatten(documents, self.columns + ['updated_at'])
+        arrays = {}
+        for column in self.columns:
+            if column in self.money_columns:
+                arrays[column] = minor_units_array(data[column])
+                arrays[column + '_missing'] = np.array([is_missing(value) for value in data[column]], dtype=bool)
+            elif column == 'user_id':
+                arrays[column] = np.array(data[column], dtype=np.int64)
+            elif column == 'date':
+                arrays[column] = np.array(data[column], dtype='datetime64[ns]')
+            else:
+                arrays[column] = np.array(data[column], dtype=object)
+        arrays['updated_at'] = np.array(data['updated_at'], dtype='datetime64[ns]')
+
+        return arrays
+
+    def _decimals(self, minor_units, missing):
+        """ Returns int64 minor units as an object array of Decimal, with NaN for missing values """
+        (codes, uniques) = pd.factorize(minor_units)
+        decimals = np.array([from_minor_units(unique) for unique in uniques], dtype=object)[codes]
+        decimals[missing] = Decimal('NaN')
+        return decimals
+
+    def _watermark(self, arrays):
+        """ Returns the latest updated_at of the passed snapshot arrays as a string, or None """
+        updated_at = pd.Series(arrays['updated_at']).max()  # skips NaT
+        if pd.isnull(updated_at):
+            return None
+        return str(updated_at)
+
+    def _updated_at(self, document):
+        """ Returns the updated_at of a raw CommonTransaction as int64 nanoseconds, as stored in a snapshot """
+        return np.datetime64(document.get('updated_at'), 'ns').astype(np.int64)
+
+    def _version_time(self, name):
+        """ Returns when the version directory was written (0 for versions named before it was recorded) """
+        try:
+            return int(name.split('-')[0])
+        except ValueError:
+            return 0
+
+    def _naive_utc(self, date):
+        """ Returns the passed date as a naive UTC datetime64, which is how MongoDB stores dates """
+        date = pd.Timestamp(date)
+        if date.tzinfo is not None:
+            date = date.tz_convert(None)
+        return date.to_datetime64()
@@ -0,0 +1,9 @@
+from r2d2.celery import app
+
+
+@app.task
+def backfill_converted_amounts_task(user_id, batch_size=1000):
+    """ Stores the converted amounts of the user's CommonTransactions imported without them """
+    from r2d2.common_layer.currency import backfill_converted_amounts
+
+    return backfill_converted_amounts(user_id, batch_size=batch_size)
@@ -1,16 +1,28 @@
 # -*- coding: utf-8 -*-
 """ tests for basic functionality of common layer - creating & updating objects on signals """
+from bson.int64 import Int64
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from freezegun import freeze_time
 from decimal import Decimal
+import os
+import shutil
+import tempfile
+import time
 
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import override_settings
 from django.utils import timezone
+import numpy as np
 import pandas as pd
 
 from r2d2.common_layer.models import CommonTransaction, ExchangeRate, ExchangeRateSource, CommonTransactionDataFrame
+from r2d2.common_layer.rollups import DailySalesRollup, daily_sales_rollup_df, update_daily_sales_rollup
 import r2d2.common_layer.models as clmodels
 import r2d2.common_layer.currency as curr
 from r2d2.common_layer.signals import object_imported
+from r2d2.common_layer.snapshots import TransactionSnapshot
 from r2d2.etsy_api.models import EtsyAccount
 from r2d2.shopify_api.models import ShopifyStore
 from r2d2.utils.test_utils import APIBaseTestCase
@@ -64,6 +76,7 @@ class TestBase(APIBaseTestCase):
 
     def tearDown(self):
         CommonTransaction.objects.all().delete()
+        DailySalesRollup.objects.all().delete()
         ExchangeRate.objects.all().delete()
         ExchangeRateSource.objects.all().delete()
 
@@ -167,3 +180,527 @@ class TestBase(APIBaseTestCase):
                          this_rate.value*common_transaction.products[0].discount)
         self.assertEqual(test_df_converted.product_total_converted.iloc[0],
                          this_rate.value*common_transaction.products[0].total)
+
+    def test_common_transactions_to_df(self):
+        """ - Test common_transactions_to_df matches a DataFrame built row by row, dtypes included
+            - Test transactions without products and empty querysets
+        """
+        now = datetime(2016, 8, 28, 12)
+        for i in range(3):
+            sample_object = self._get_sample_transaction(i, now - timedelta(days=i))
+            sample_object['products'] = sample_object['products'] * i
+            object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        object_imported.send(sender=None, importer_account=self.etsy_account,
+                             mapped_data=self._get_sample_transaction(3, now))
+
+        columns = clmodels.get_unpack_columns()
+        txns = CommonTransaction.objects.order_by('transaction_id')
+        rows = [[getattr(txn, column) for column in columns if not column.startswith('product_')] +
+                [getattr(product, column[len('product_'):]) for column in columns if column.startswith('product_')]
+                for txn in txns for product in txn.products]
+        expected_df = pd.DataFrame(rows, columns=columns)
+        expected_df['date'] = pd.to_datetime(expected_df['date'])
+
+        test_df = clmodels.common_transactions_to_df(txns)
+        self.assertEqual(test_df.shape, (4, len(columns)))
+        self.assertEqual(test_df.dtypes.tolist(), expected_df.dtypes.tolist())
+        for column in columns:
+            self.assertEqual(test_df[column].tolist(), expected_df[column].tolist(), column)
+
+        self.assertIsNone(clmodels.common_transactions_to_df(CommonTransaction.objects.filter(user_id=2)))
+        self.assertEqual(clmodels.common_transactions_to_df(txns.filter(transaction_id__endswith='_0')).shape,
+                         (0, len(columns)))
+
+    def test_find_columns(self):
+        """ - Test CommonTransactionDataFrame.find returns only the requested columns
+            - Test the requested columns match the full DataFrame
+            - Test unknown columns are rejected
+        """
+        now = datetime.now()
+        for transaction_id in range(1, 4):
+            sample_object = self._get_sample_transaction(transaction_id, now)
+            object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+
+        full_df = CommonTransactionDataFrame.find(user_id=1)
+        self.assertEqual(list(full_df.columns), CommonTransactionDataFrame.get_columns())
+
+        columns = ['transaction_id', 'date', 'product_total', 'total_discount']
+        test_df = CommonTransactionDataFrame.find(user_id=1, columns=columns)
+        self.assertEqual(list(test_df.columns), columns)
+        self.assertEqual(len(test_df.index), len(full_df.index))
+        for column in columns:
+            self.assertEqual(test_df[column].tolist(), full_df[column].tolist())
+        self.assertEqual(test_df.product_total.iloc[0], Decimal('9.0'))
+
+        self.assertEqual(CommonTransactionDataFrame.find(user_id=2, columns=columns).shape[0], 0)
+        self.assertRaises(ValueError, CommonTransactionDataFrame.find, user_id=1, columns=['foo'])
+
+    def test_find_chunks(self):
+        """ - Test CommonTransactionDataFrame.find with chunksize yields DataFrame chunks
+            - Test the chunks add up to the full DataFrame
+        """
+        now = datetime.now()
+        for transaction_id in range(1, 6):
+            sample_object = self._get_sample_transaction(transaction_id, now)
+            object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+
+        full_df = CommonTransactionDataFrame.find(user_id=1)
+        chunks = list(CommonTransactionDataFrame.find(user_id=1, chunksize=2))
+        self.assertEqual([chunk.shape[0] for chunk in chunks], [2, 2, 1])
+
+        chunked_df = pd.concat(chunks, ignore_index=True)
+        self.assertEqual(list(chunked_df.columns), list(full_df.columns))
+        self.assertEqual(sorted(chunked_df.transaction_id.tolist()), sorted(full_df.transaction_id.tolist()))
+        self.assertEqual(list(CommonTransactionDataFrame.find(user_id=2, chunksize=2)), [])
+
+    def test_fixed_point(self):
+        """ - Test fixed point DataFrames hold int64 minor units that match the Decimal DataFrames
+            - Test currency conversion of fixed point DataFrames
+        """
+        now = datetime.now()
+        sample_object = self._get_sample_transaction(1, now)
+        sample_object['products'][0]['total'] = 9.12345
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+
+        decimal_df = CommonTransactionDataFrame.find(user_id=1)
+        fixed_df = CommonTransactionDataFrame.find(user_id=1, fixed_point=True)
+        queryset_df = clmodels.common_transactions_to_df(CommonTransaction.objects.all(), fixed_point=True)
+        for column in clmodels.get_money_columns():
+            self.assertEqual(fixed_df[column].dtype.kind, 'i')
+            self.assertEqual(fixed_df[column].tolist(), queryset_df[column].tolist())
+            self.assertEqual([clmodels.from_minor_units(value) for value in fixed_df[column]],
+                             decimal_df[column].tolist())
+        self.assertEqual(fixed_df.product_total.iloc[0], 912345)
+
+        rates = ExchangeRate.objects.all()
+        fixed_df.date = pd.to_datetime(rates[0].date)
+        converted_df = curr.convert_common_transactions_df(fixed_df, 'USD', True)
+        self.assertEqual(converted_df.product_total_converted.dtype.kind, 'i')
+        self.assertEqual(converted_df.product_total_converted.iloc[0], 912345 * rates[0].value)
+
+        converted_df = clmodels.money_columns_to_decimal(converted_df)
+        self.assertEqual(converted_df.product_total_converted.iloc[0], Decimal('9.12345') * rates[0].value)
+
+    def test_fixed_point_conversion(self):
+        """ - Test fixed point conversion rounds the exact converted amounts to the nearest minor unit
+            - Test rows without a rate convert to NaN in both fixed point and Decimal DataFrames
+        """
+        today = timezone.now().date()
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='CAD', value=Decimal('0.123457'), source=source, date=today)
+        amounts = [Decimal('9.12345'), Decimal('-0.00015'), Decimal('123456.78901'), Decimal(5), Decimal('2.5')]
+        decimal_df = pd.DataFrame({'date': pd.to_datetime([today] * 5),
+                                   'currency_code': ['CAD', 'CAD', 'EUR', 'GBP', 'USD'],
+                                   'product_total': amounts})
+        fixed_df = decimal_df.copy()
+        fixed_df['product_total'] = clmodels.minor_units_array(amounts)
+
+        decimal_df = curr.convert_common_transactions_df(decimal_df, 'USD', True)
+        fixed_df = curr.convert_common_transactions_df(fixed_df, 'USD', True)
+        self.assertEqual(fixed_df.product_total_converted.dtype.kind, 'f')
+        self.assertTrue(np.isnan(fixed_df.product_total_converted.iloc[3]))
+        self.assertTrue(np.isnan(decimal_df.product_total_converted.iloc[3]))
+
+        fixed_df = clmodels.money_columns_to_decimal(fixed_df)
+        for (fixed, exact) in zip(fixed_df.product_total_converted, decimal_df.product_total_converted):
+            if pd.isnull(exact):
+                self.assertTrue(fixed.is_nan())
+            else:
+                self.assertEqual(fixed, exact.quantize(Decimal('0.00001')))
+        self.assertEqual(fixed_df.product_total_converted.tolist()[:2], [Decimal('1.12635'), Decimal('-0.00002')])
+
+        fixed_df = decimal_df[decimal_df.currency_code != 'GBP'][['date', 'currency_code', 'product_total']].copy()
+        fixed_df['product_total'] = clmodels.minor_units_array(fixed_df.product_total)
+        fixed_df = curr.convert_common_transactions_df(fixed_df, 'USD', True)
+        self.assertEqual(fixed_df.product_total_converted.dtype, np.int64)
+
+    def test_money_minor_units(self):
+        """ - Test money fields are stored as integer minor units when enabled
+            - Test both storage formats read back as the same Decimals
+            - Test convert_money_to_minor_units rewrites stored doubles
+        """
+        now = datetime.now()
+        coll = CommonTransaction._get_collection()
+        sample_object = self._get_sample_transaction(1, now)
+        sample_object['products'][0]['total'] = 9.12345
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        self.assertEqual(coll.find_one()['products'][0]['total'], 9.12345)
+        double_df = CommonTransactionDataFrame.find(user_id=1)
+
+        with override_settings(COMMON_LAYER_MONEY_AS_MINOR_UNITS=True):
+            object_imported.send(sender=None, importer_account=self.etsy_account, mapped_data=sample_object)
+        document = coll.find_one({'data_provider_name': self.etsy_account.__class__.__name__})
+        self.assertTrue(isinstance(document['products'][0]['total'], Int64))
+        self.assertEqual(document['products'][0]['total'], 912345)
+        self.assertEqual(CommonTransaction.objects.get(id=document['_id']).products[0].total, Decimal('9.12345'))
+
+        test_df = CommonTransactionDataFrame.find(user_id=1)
+        for column in clmodels.get_money_columns():
+            self.assertEqual(test_df[column].tolist(), double_df[column].tolist() * 2)
+
+        call_command('convert_money_to_minor_units')
+        for document in coll.find():
+            self.assertTrue(isinstance(document['total_total'], Int64))
+            self.assertTrue(isinstance(document['products'][0]['price'], Int64))
+        test_df = CommonTransactionDataFrame.find(user_id=1)
+        self.assertEqual(test_df.product_total.tolist(), [Decimal('9.12345')] * 2)
+
+    def test_snapshot(self):
+        """ - Test reading from a snapshot matches reading from MongoDB
+            - Test new and re-imported transactions are appended to the snapshot
+            - Test the snapshot is rebuilt when transactions are deleted
+        """
+        now = datetime.now()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+
+        def assert_snapshot_matches(**kwargs):
+            with override_settings(COMMON_LAYER_SNAPSHOT_ROOT=root):
+                snapshot_df = CommonTransactionDataFrame.find(user_id=1, snapshot=True, **kwargs)
+            test_df = CommonTransactionDataFrame.find(user_id=1, **kwargs)
+            self.assertEqual(snapshot_df.transaction_id.tolist(), test_df.transaction_id.tolist())
+            self.assertEqual(snapshot_df.date.tolist(), test_df.date.tolist())
+            self.assertEqual(snapshot_df.product_total.tolist(), test_df.product_total.tolist())
+            self.assertEqual(snapshot_df.dtypes.tolist(), test_df.dtypes.tolist())
+
+        for i in range(3):
+            object_imported.send(sender=None, importer_account=self.shopify_account,
+                                 mapped_data=self._get_sample_transaction(i, now - timedelta(days=i)))
+        assert_snapshot_matches()
+        assert_snapshot_matches(fixed_point=True)
+
+        sample_object = self._get_sample_transaction(1, now)
+        sample_object['products'][0]['total'] = 5.0
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        object_imported.send(sender=None, importer_account=self.etsy_account,
+                             mapped_data=self._get_sample_transaction(3, now))
+        assert_snapshot_matches()
+
+        CommonTransaction.objects.filter(source=self.etsy_account.official_channel_name).delete()
+        assert_snapshot_matches()
+        assert_snapshot_matches(start_date=now - timedelta(days=1))
+
+    def test_snapshot_versions(self):
+        """ - Test transactions updated in place (without a new _id) are picked up by the snapshot
+            - Test writing a snapshot only removes the versions older than it
+            - Test a snapshot that can't be written falls back on MongoDB
+        """
+        now = datetime.now()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        for i in range(3):
+            object_imported.send(sender=None, importer_account=self.shopify_account,
+                                 mapped_data=self._get_sample_transaction(i, now - timedelta(days=i)))
+
+        with override_settings(COMMON_LAYER_SNAPSHOT_ROOT=root):
+            snapshot = TransactionSnapshot(1)
+            self.assertEqual(snapshot.find().shape[0], 3)
+
+            coll = CommonTransaction._get_collection()
+            coll.update_one({'transaction_id': {'$regex': '1$'}},
+                            {'$set': {'products.0.total': Int64(50000), 'updated_at': datetime.utcnow()}})
+            snapshot_df = snapshot.find(fixed_point=True)
+            test_df = CommonTransactionDataFrame.find(user_id=1, fixed_point=True)
+            self.assertEqual(sorted(snapshot_df.product_total.tolist()), sorted(test_df.product_total.tolist()))
+            self.assertIn(50000, snapshot_df.product_total.tolist())
+
+            (meta, arrays) = snapshot.load()
+            newer = os.path.join(snapshot.path, '%d-filling' % (int(time.time() * 1000000) + 10 ** 9))
+            older = os.path.join(snapshot.path, '1-abandoned')
+            os.makedirs(newer)
+            os.makedirs(older)
+            snapshot.rebuild()
+            self.assertTrue(os.path.isdir(newer))
+            self.assertFalse(os.path.isdir(older))
+            self.assertTrue(os.path.isdir(os.path.join(snapshot.path, meta['version'])))
+
+        (handle, path) = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with override_settings(COMMON_LAYER_SNAPSHOT_ROOT=path):  # a file:  snapshots can't be written
+            self.assertIsNone(TransactionSnapshot(1).find())
+            self.assertEqual(CommonTransactionDataFrame.find(user_id=1, snapshot=True).shape[0], 3)
+
+    def test_daily_sales_rollup(self):
+        """ - Test imports are added to the daily sales rollup
+            - Test re-imports replace the previous version of the transaction
+            - Test replaying an update leaves the rollup as is
+            - Test rebuild_daily_sales_rollup recomputes the same rollup
+            - Test transactions without a date are left out of the rollup
+        """
+        now = datetime(2016, 8, 28, 12)
+        for i in range(3):
+            object_imported.send(sender=None, importer_account=self.shopify_account,
+                                 mapped_data=self._get_sample_transaction(i, now))
+
+        rollup_df = daily_sales_rollup_df(1)
+        self.assertEqual(rollup_df.shape[0], 1)
+        self.assertEqual(rollup_df.date.tolist(), [pd.Timestamp('2016-08-28')])
+        self.assertEqual(rollup_df.product_total.tolist(), [Decimal(27)])
+        self.assertEqual(rollup_df.product_discount.tolist(), [Decimal(6)])
+        self.assertEqual(rollup_df.product_quantity.tolist(), [3])
+        self.assertEqual(rollup_df.transaction_count.tolist(), [3])
+
+        # move one transaction to the previous day and change its total
+        sample_object = self._get_sample_transaction(2, now - timedelta(days=1))
+        sample_object['products'][0]['total'] = 5.5
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+
+        rollup_df = daily_sales_rollup_df(1, fixed_point=True)
+        self.assertEqual(rollup_df.date.tolist(), [pd.Timestamp('2016-08-27'), pd.Timestamp('2016-08-28')])
+        self.assertEqual(rollup_df.product_total.tolist(), [550000, 1800000])
+        self.assertEqual(rollup_df.transaction_count.tolist(), [1, 2])
+
+        document = CommonTransaction.objects.get(transaction_id__endswith='2').to_mongo()
+        update_daily_sales_rollup(document, document)
+        self.assertTrue(daily_sales_rollup_df(1, fixed_point=True).equals(rollup_df))
+
+        # renaming the product replaces its rollup
+        sample_object = self._get_sample_transaction(2, now - timedelta(days=1))
+        sample_object['products'][0]['name'] = 'renamed'
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        self.assertEqual(daily_sales_rollup_df(1).product_name.tolist(), ['renamed', 'test'])
+
+        sample_object = self._get_sample_transaction(2, now - timedelta(days=1))
+        sample_object['products'][0]['total'] = 5.5
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        call_command('rebuild_daily_sales_rollup', user_id=1)
+        self.assertTrue(daily_sales_rollup_df(1, fixed_point=True).equals(rollup_df))
+
+        # transactions without a date are imported, but not rolled up
+        sample_object = self._get_sample_transaction(3, now)
+        sample_object['date'] = None
+        object_imported.send(sender=None, importer_account=self.shopify_account, mapped_data=sample_object)
+        self.assertEqual(CommonTransaction.objects.filter(transaction_id__endswith='_3').count(), 1)
+        self.assertTrue(daily_sales_rollup_df(1, fixed_point=True).equals(rollup_df))
+        object_imported.send(sender=None, importer_account=self.shopify_account,
+                             mapped_data=self._get_sample_transaction(3, now))
+        self.assertEqual(daily_sales_rollup_df(1).transaction_count.tolist(), [1, 3])
+
+    def test_find_compact(self):
+        """ - Test compact CommonTransactionDataFrames hold the same data in smaller dtypes """
+        now = datetime.now()
+        for i in range(3):
+            object_imported.send(sender=None, importer_account=self.shopify_account,
+                                 mapped_data=self._get_sample_transaction(i, now))
+
+        test_df = CommonTransactionDataFrame.find(user_id=1)
+        compact_df = CommonTransactionDataFrame.find(user_id=1, compact=True)
+        for column in clmodels.get_categorical_columns():
+            self.assertEqual(compact_df[column].dtype.name, 'category')
+        self.assertEqual(compact_df.user_id.dtype, np.int32)
+        self.assertEqual(compact_df.data_provider_id.dtype, np.int32)
+        for column in test_df.columns:
+            self.assertEqual(list(compact_df[column]), list(test_df[column]))
+        self.assertTrue(compact_df.memory_usage(deep=True).sum() < test_df.memory_usage(deep=True).sum())
+
+    def test_rate_cache(self):
+        """ - Test MoneyConverter's cached rate lookups match the DB lookups """
+        curr.MoneyConverter.load_exchange_rates(force=True)
+        today = timezone.now().date()
+        yesterday = today - timedelta(days=1)
+
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'USD', today), Decimal(100))
+        noon = datetime(yesterday.year, yesterday.month, yesterday.day, 12)
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'USD', noon), Decimal(10))
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'USD', today + timedelta(days=5), False),
+                         Decimal(100))
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'USD', today - timedelta(days=5), False),
+                         Decimal(10))
+        self.assertRaises(LookupError, curr.MoneyConverter.get_rate_cached, 'EUR', 'USD', today + timedelta(days=5))
+        self.assertRaises(LookupError, curr.MoneyConverter.get_rate_cached, 'GBP', 'USD', today)
+
+        for date in [today, yesterday, today + timedelta(days=5)]:
+            self.assertEqual(curr.convert(Decimal(2), 'EUR', 'USD', date, False, use_cache=True),
+                             curr.convert(Decimal(2), 'EUR', 'USD', date, False))
+
+    def test_nearest_rate_conversion(self):
+        """ - Test converting with force_date=False uses each row's nearest rate for its currency """
+        today = timezone.now().date()
+        df = pd.DataFrame({'date': pd.to_datetime([today - timedelta(days=10), today, today + timedelta(days=3),
+                                                   today]),
+                           'currency_code': ['EUR', 'EUR', 'EUR', 'GBP'],
+                           'product_total': [Decimal(1), Decimal(2), Decimal(3), Decimal(4)]})
+
+        converted_df = curr.convert_common_transactions_df(df, 'USD', False)
+        self.assertEqual(list(converted_df.nearest_date), [today - timedelta(days=1), today, today, None])
+        self.assertEqual(converted_df.product_total_converted.tolist()[:3], [Decimal(10), Decimal(200), Decimal(300)])
+        self.assertTrue(np.isnan(converted_df.product_total_converted.iloc[3]))
+
+    def test_identity_conversion(self):
+        """ - Test rows already in the target currency convert with a rate of 1, without an ExchangeRate """
+        today = timezone.now().date()
+        df = pd.DataFrame({'date': pd.to_datetime([today, today, today]),
+                           'currency_code': ['USD', 'EUR', 'USD'],
+                           'product_total': [Decimal('1.5'), Decimal(2), Decimal('NaN')]})
+
+        converted_df = curr.convert_common_transactions_df(df.copy(), 'USD', True)
+        self.assertEqual(converted_df.value.tolist(), [Decimal(1), Decimal(100), Decimal(1)])
+        self.assertEqual(converted_df.product_total_converted.tolist()[:2], [Decimal('1.5'), Decimal(200)])
+        self.assertTrue(converted_df.product_total_converted.iloc[2].is_nan())
+
+        converted_df = curr.convert_common_transactions_df(df[df.currency_code == 'USD'].copy(), 'USD', False)
+        self.assertEqual(converted_df.product_total_converted.iloc[0], Decimal('1.5'))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       EXCHANGE_RATES_VERSION_TIMEOUT=0)
+    def test_exchange_rate_cache(self):
+        """ - Test exchange rates are served from the cache until their source's last_update changes """
+        cache.clear()
+        today = timezone.now().date()
+        self.assertEqual(len(curr.get_exchange_rates()[('EUR', 'USD')][0]), 2)
+
+        with self.assertNumQueries(1):  # only the version
+            self.assertEqual(curr.get_exchange_rates([('EUR', 'USD'), ('GBP', 'USD')]).keys(), [('EUR', 'USD')])
+
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='EUR', value=Decimal(1000), source=source,
+                                    date=today + timedelta(days=1))
+        self.assertEqual(len(curr.get_exchange_rates()[('EUR', 'USD')][0]), 2)
+
+        source.last_update = today + timedelta(days=1)
+        source.save()
+        self.assertEqual(len(curr.get_exchange_rates()[('EUR', 'USD')][0]), 3)
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'USD', today + timedelta(days=1)), Decimal(1000))
+
+    def test_exchange_rates_to_df(self):
+        """ - Test exchange_rates_to_df reads typed columns in a single query, filtered by currency and date """
+        today = timezone.now().date()
+        with self.assertNumQueries(1):
+            rdf = curr.exchange_rates_to_df(ExchangeRate.objects.all())
+        self.assertEqual(sorted(rdf.id.tolist()), [1, 2])
+        self.assertEqual(rdf.base_currency.tolist(), ['USD', 'USD'])
+        self.assertEqual(rdf.date.dtype.kind, 'M')
+        self.assertEqual(sorted(rdf.value.tolist()), [Decimal(10), Decimal(100)])
+
+        rdf = curr.exchange_rates_to_df(ExchangeRate.objects.all(), currencies=['EUR'], start_date=today)
+        self.assertEqual(rdf.value.tolist(), [Decimal(100)])
+        self.assertEqual(rdf.date.tolist(), [pd.Timestamp(today)])
+        self.assertIsNone(curr.exchange_rates_to_df(ExchangeRate.objects.all(), currencies=['GBP']))
+        self.assertIsNone(curr.exchange_rates_to_df(ExchangeRate.objects.all(), end_date=today - timedelta(days=2)))
+
+    def test_cross_rate_conversion(self):
+        """ - Test currencies without a direct rate convert through the base currency """
+        today = timezone.now().date()
+        yesterday = today - timedelta(days=1)
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='GBP', value=Decimal(2), source=source, date=today)
+        curr.MoneyConverter.load_exchange_rates(force=True)
+
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('EUR', 'GBP', today), Decimal(50))
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('USD', 'GBP', today), Decimal('0.5'))
+        self.assertEqual(curr.MoneyConverter.get_rate_cached('GBP', 'EUR', yesterday, False), Decimal('0.2'))
+        self.assertRaises(LookupError, curr.MoneyConverter.get_rate_cached, 'EUR', 'GBP', yesterday)
+
+        df = pd.DataFrame({'date': pd.to_datetime([today, yesterday, today, today]),
+                           'currency_code': ['EUR', 'EUR', 'USD', 'GBP'],
+                           'product_total': [Decimal(1), Decimal(1), Decimal(3), Decimal(4)]})
+        converted_df = curr.convert_common_transactions_df(df.copy(), 'GBP', True)
+        amounts = converted_df.product_total_converted.tolist()
+        self.assertEqual(amounts[:1] + amounts[2:], [Decimal(50), Decimal('1.5'), Decimal(4)])
+        self.assertTrue(np.isnan(converted_df.value.iloc[1]))
+
+        converted_df = curr.convert_common_transactions_df(df.copy(), 'GBP', False)
+        self.assertEqual(converted_df.product_total_converted.tolist(),
+                         [Decimal(50), Decimal(5), Decimal('1.5'), Decimal(4)])
+        self.assertEqual(list(converted_df.nearest_date), [today, yesterday, today, today])
+
+    def test_cross_rate_pair_order(self):
+        """ - Test cross rates are resolved whatever the order of the other pairs in the rates """
+        day = np.datetime64(timezone.now().date(), 'D')
+        dates = np.array([day], dtype='datetime64[D]')
+        pairs = [(('EUR', 'CHF'), (dates, np.array([Decimal(3)], dtype=object))),
+                 (('EUR', 'USD'), (dates, np.array([Decimal(10)], dtype=object))),
+                 (('GBP', 'USD'), (dates, np.array([Decimal(2)], dtype=object))),
+                 (('CHF', 'GBP'), (dates, np.array([Decimal(7)], dtype=object)))]
+        currencies = np.array(['EUR', 'CHF', 'GBP'], dtype=object)
+        days = np.array([day, day, day], dtype='datetime64[D]')
+
+        for rates in [OrderedDict(pairs), OrderedDict(reversed(pairs))]:
+            for force_date in [True, False]:
+                (rate_dates, values) = curr.resolve_rates(currencies, days, 'GBP', rates, force_date, 'USD')
+                self.assertEqual(values.tolist(), [Decimal(5), Decimal(7), Decimal(1)])
+
+    def test_cross_rate_lookup(self):
+        """ - Test get_rate() and convert() fall back on the cross rate through the base currency """
+        today = timezone.now().date()
+        yesterday = today - timedelta(days=1)
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='GBP', value=Decimal(2), source=source, date=today)
+        curr.MoneyConverter.load_exchange_rates(force=True)
+
+        self.assertEqual(curr.get_rate('EUR', 'GBP', today).value, Decimal(50))
+        self.assertEqual(curr.get_rate('USD', 'GBP', today).value, Decimal('0.5'))
+        self.assertEqual(curr.get_rate('EUR', 'GBP', yesterday, False).value, Decimal(5))
+        self.assertEqual(curr.get_rate('EUR', 'GBP', yesterday, False).date, yesterday)
+        self.assertRaises(LookupError, curr.get_rate, 'EUR', 'GBP', yesterday)
+        self.assertRaises(LookupError, curr.get_rate, 'EUR', 'JPY', today, False)
+
+        for date in [today, yesterday, today + timedelta(days=5)]:
+            self.assertEqual(curr.convert(Decimal(2), 'GBP', 'EUR', date, False),
+                             curr.convert(Decimal(2), 'GBP', 'EUR', date, False, use_cache=True))
+
+    def test_converted_amounts_at_import(self):
+        """ - Test imported transactions store their amounts converted with the rate of their day
+            - Test the stored amounts are used in place of converting them again
+            - Test transactions imported before their day's rate are backfilled
+        """
+        curr.MoneyConverter.load_exchange_rates(force=True)
+        today = timezone.now().date()
+        noon = datetime(today.year, today.month, today.day, 12)
+        object_imported.send(sender=None, importer_account=self.shopify_account,
+                             mapped_data=self._get_sample_transaction(1, noon))
+        object_imported.send(sender=None, importer_account=self.shopify_account,
+                             mapped_data=self._get_sample_transaction(2, noon + timedelta(days=1)))
+
+        txn = CommonTransaction.objects.get(transaction_id__endswith='1')
+        self.assertEqual((txn.reporting_currency, txn.exchange_rate), ('USD', Decimal(100)))
+        self.assertEqual((txn.total_total_converted, txn.products[0].total_converted), (Decimal(900), Decimal(900)))
+        self.assertIsNone(CommonTransaction.objects.get(transaction_id__endswith='2').reporting_currency)
+
+        stored_df = CommonTransactionDataFrame.find(user_id=1, converted=True)
+        stored_df = curr.convert_stored_common_transactions_df(stored_df, 'USD', False)
+        converted_df = curr.convert_common_transactions_df(CommonTransactionDataFrame.find(user_id=1), 'USD', False)
+        self.assertEqual(list(stored_df.columns), list(converted_df.columns))
+        for column in ['nearest_date', 'value', 'product_total_converted', 'total_tax_converted']:
+            self.assertEqual(stored_df[column].tolist(), converted_df[column].tolist())
+
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='EUR', value=Decimal(1000), source=source,
+                                    date=today + timedelta(days=1))
+        source.last_update = today + timedelta(days=1)
+        source.save()
+        cache.clear()
+        curr.MoneyConverter.load_exchange_rates(force=True)
+        self.assertEqual(curr.backfill_converted_amounts(1), 1)
+        self.assertEqual(curr.backfill_converted_amounts(1), 0)
+        self.assertEqual(CommonTransaction.objects.get(transaction_id__endswith='2').products[0].total_converted,
+                         Decimal(9000))
+
+    def test_duplicate_rates_at_import(self):
+        """ - Test a transaction whose day has more than one rate is imported unconverted
+            - Test the backfill only tries it again once the rates change
+        """
+        today = timezone.now().date()
+        noon = datetime(today.year, today.month, today.day, 12)
+        source = ExchangeRateSource.objects.get(id=1)
+        ExchangeRate.objects.create(id=3, currency='EUR', value=Decimal(101), source=source, date=today)
+        cache.clear()
+        curr.MoneyConverter.load_exchange_rates(force=True)
+
+        object_imported.send(sender=None, importer_account=self.shopify_account,
+                             mapped_data=self._get_sample_transaction(1, noon))
+        txn = CommonTransaction.objects.get()
+        self.assertIsNone(txn.reporting_currency)
+        self.assertEqual(txn.rates_version, curr.rates_version('USD'))
+        self.assertEqual(curr.backfill_converted_amounts(1), 0)
+
+        ExchangeRate.objects.filter(id=3).delete()
+        source.last_update = today + timedelta(days=1)
+        source.save()
+        cache.clear()
+        curr.MoneyConverter.load_exchange_rates(force=True)
+        self.assertEqual(curr.backfill_converted_amounts(1), 1)
+        txn = CommonTransaction.objects.get()
+        self.assertEqual((txn.reporting_currency, txn.exchange_rate), ('USD', Decimal(100)))
+        self.assertEqual(txn.rates_version, curr.rates_version('USD'))
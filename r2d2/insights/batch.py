@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Batch insight generation:  runs InsightDispatcher for the data provider accounts of
+every approved user, a shard of users at a time, instead of one account at a time in
+the data_fetched signal.  Run with the generate_insights management command, either
+over a local pool of processes or as one generate_insights_task Celery task per shard.
+
+The transactions of a shard are read from MongoDB with one query for its line items
+and one for its daily sales rollups, since the earliest date its InsightModels need (see
+ShardTransactions), rather than once per account and InsightModel.
+"""
+import logging
+from multiprocessing import Pool
+import time
+
+from django import db
+from django.conf import settings
+from mongoengine.connection import get_connection
+
+from r2d2.accounts.models import Account
+from r2d2.common_layer.models import CommonTransactionDataFrame as CTDF
+from r2d2.common_layer.rollups import daily_sales_rollup_df
+import r2d2.common_layer.currency as curr
+
+logger = logging.getLogger('django')
+
+
+def approved_user_ids():
+    """ Returns the IDs of the active, approved users, in order """
+    return list(Account.objects.filter(approval_status=Account.APPROVED, is_active=True)
+                .order_by('id').values_list('id', flat=True))
+
+
+def shards(user_ids, shard_size):
+    """ Splits user_ids into consecutive lists of at most shard_size IDs """
+    return [user_ids[i:i + shard_size] for i in range(0, len(user_ids), max(shard_size, 1))]
+
+
+def data_provider_accounts(user_ids):
+    """
+    Returns the active accounts of every registered DataImporter model of the users,
+    as a list per user ID
+    """
+    from r2d2.data_importer.api import DataImporter
+
+    accounts = dict((user_id, []) for user_id in user_ids)
+    for model in DataImporter.get_registered_models():
+        for account in model.objects.filter(user_id__in=user_ids, is_active=True).select_related('user'):
+            accounts[account.user_id].append(account)
+
+    for user_accounts in accounts.values():
+        user_accounts.sort(key=lambda account: (account.__class__.__name__, account.id))
+    return accounts
+
+
+def split_by_user(txns):
+    """ Returns the rows of txns of each user, by user ID """
+    if txns is None or txns.shape[0] == 0:
+        return {}
+    return dict((user_id, user_txns.reset_index(drop=True)) for (user_id, user_txns) in txns.groupby('user_id'))
+
+
+class ShardTransactions(object):
+    """
+    The converted transactions and daily sales rollups of a shard of users, each read
+    with a single MongoDB query the first time an InsightModel needs them, since the
+    earliest date it needs.  They are only read again (for the users not released yet)
+    if a later InsightModel looks further back.  load() is passed to
+    InsightDispatcher.trigger() in place of InsightDispatcher.load_transactions()
+    """
+    def __init__(self, user_ids, compact=False):
+        self.user_ids = list(user_ids)
+        self.compact = compact
+        self.frames = {}  # frames by user ID, by whether they're daily sales rollups
+        self.starts = {}  # the date each kind of frames was read since, None for the full history
+        self.released = set()
+
+    def user_frames(self, uses_rollup, start_date=None, compact=False):
+        """
+        Returns the line items (or daily sales rollups) of the shard since start_date
+        converted to USD, by user ID.  Line items are compact (see
+        CommonTransactionDataFrame.find()) if either the shard or the call asks for it
+        """
+        from r2d2.insights.generators import coversLookback
+
+        if uses_rollup not in self.frames or not coversLookback(self.starts.get(uses_rollup), start_date):
+            user_ids = [user_id for user_id in self.user_ids if user_id not in self.released]
+            if uses_rollup:
+                txns = curr.convert_common_transactions_df(daily_sales_rollup_df(user_ids, start_date=start_date),
+                                                           'USD', False)
+            else:
+                txns = CTDF.find(user_id=user_ids, start_date=start_date, compact=self.compact or compact,
+                                 converted=True)
+                txns = curr.convert_stored_common_transactions_df(txns, 'USD', False)
+            self.frames[uses_rollup] = split_by_user(txns)
+            self.starts[uses_rollup] = start_date
+
+        return self.frames[uses_rollup]
+
+    def load(self, account, insight_model, start_date=None, compact=False):
+        """
+        Returns the transactions InsightDispatcher.load_transactions() returns for the
+        account and InsightModel (None if there are none).  They may start before
+        start_date, if another user of the shard needed them to:  InsightModels filter
+        on their own window
+        """
+        txns = self.user_frames(insight_model.uses_rollup, start_date, compact).get(account.user_id)
+        if txns is None or insight_model.compares_sources:
+            return txns
+
+        txns = txns.loc[(txns.data_provider_name == account.__class__.__name__) &
+                        (txns.data_provider_id == account.id)]
+        if txns.shape[0] == 0:
+            return None
+        return txns.reset_index(drop=True)
+
+    def release(self, user_id):
+        """ Drops the user's transactions once its insights are generated """
+        self.released.add(user_id)
+        for frames in self.frames.values():
+            frames.pop(user_id, None)
+
+
+def generate_shard_insights(user_ids):
+    """
+    Runs InsightDispatcher for the data provider accounts of each of user_ids, over the
+    transactions of the shard read at once, and saves the Insights.  Returns a progress
+    report per user:  a dict of its user_id, the number of accounts, the number of
+    insights saved, the seconds taken, and the error raised, if any
+    """
+    from r2d2.insights.generators import InsightDispatcher
+
+    shard = ShardTransactions(user_ids, getattr(settings, 'INSIGHTS_COMPACT_DTYPES', False))
+    accounts = data_provider_accounts(user_ids)
+    report = []
+
+    for user_id in user_ids:
+        start = time.time()
+        progress = {'user_id': user_id, 'accounts': len(accounts[user_id]), 'insights': 0, 'error': None}
+        try:
+            for account in accounts[user_id]:
+                (insight, channels, products) = (InsightDispatcher.trigger(account, True, True, shard.load) or
+                                                 (None, None, None))
+                if insight is not None:
+                    InsightDispatcher.save_insight(account, insight, channels, products)
+                    progress['insights'] += 1
+        except Exception as e:
+            logger.exception("Generating insights for user %(user_id)s failed" % {'user_id': user_id})
+            progress['error'] = repr(e)
+
+        shard.release(user_id)
+        progress['seconds'] = time.time() - start
+        report.append(progress)
+
+    return report
+
+
+def close_connections():
+    """
+    Closes this process's database and MongoDB connections, which reopen on their next
+    use, so that processes forked afterwards don't share their sockets
+    """
+    db.connections.close_all()
+    get_connection().close()
+
+
+def generate_insights(user_ids=None, shard_size=100, processes=1):
+    """
+    Generates the insights of user_ids (of every approved user by default) shard_size
+    users at a time, over a pool of processes worker processes, or in this process if
+    processes is 1.  Yields the progress report of each user (see
+    generate_shard_insights()) as its shard completes
+    """
+    if user_ids is None:
+        user_ids = approved_user_ids()
+    user_shards = shards(list(user_ids), shard_size)
+
+    if processes <= 1:
+        for user_shard in user_shards:
+            for progress in generate_shard_insights(user_shard):
+                yield progress
+        return
+
+    close_connections()
+    pool = Pool(processes)
+    try:
+        for report in pool.imap_unordered(generate_shard_insights, user_shards):
+            for progress in report:
+                yield progress
+    finally:
+        pool.close()
+        pool.join()
@@ -5,18 +5,26 @@ import logging
 from bson.code import Code
 from datetime import datetime, timedelta
 from functools import partial
+from multiprocessing.pool import ThreadPool
 from collections import OrderedDict
 from decimal import Decimal
+import heapq
 import importlib
+import itertools
 import math
+import sys
+import threading
 
 import pandas as pd
 import numpy as np
 
+from django.conf import settings
 from django.db import transaction
+from django.utils import six
 
 from r2d2.common_layer.models import CommonTransaction
 from r2d2.common_layer.models import CommonTransactionDataFrame as CTDF
+from r2d2.common_layer.rollups import daily_sales_rollup_df
 import r2d2.common_layer.models as clmodels
 import r2d2.common_layer.currency as curr
 
@@ -43,22 +51,27 @@ class BaseGenerator(object):
 
         if cls.should_be_triggered(account, success, fetched_from_all):
             (insight, channels, products) = cls.trigger(account, success, fetched_from_all) or (None, None, None)
-            if insight:
-                # explicit transaction here to allow channels and products to be saved before post_save is called
-                with transaction.atomic():
-                    insight.user = account.user
-                    insight.data_provider_name = account.__class__.__name__
-                    insight.data_provider_id = account.id
-                    insight.generator_class = cls.__name__
-                    insight.save()
+            cls.save_insight(account, insight, channels, products)
 
-                    if channels:
-                        # change this to insight.product_set.set(channels) if upgrading to Django 1.10+
-                        insight.channel_set = channels
-
-                    if products:
-                        # change this to insight.product_set.set(products) if upgrading to Django 1.10+
-                        insight.product_set = products
+    @classmethod
+    def save_insight(cls, account, insight, channels=None, products=None):
+        """ Saves the Insight returned by trigger() for the account, if any """
+        if insight:
+            # explicit transaction here to allow channels and products to be saved before post_save is called
+            with transaction.atomic():
+                insight.user = account.user
+                insight.data_provider_name = account.__class__.__name__
+                insight.data_provider_id = account.id
+                insight.generator_class = cls.__name__
+                insight.save()
+
+                if channels:
+                    # change this to insight.product_set.set(channels) if upgrading to Django 1.10+
+                    insight.channel_set = channels
+
+                if products:
+                    # change this to insight.product_set.set(products) if upgrading to Django 1.10+
+                    insight.product_set = products
 
 
 class InsightModel(object):
@@ -79,11 +92,41 @@ class InsightModel(object):
     priority = None  # the relative importance of this Insight
     shows_table = False  # whether this insight shows a table
     output_message = None  # the template message this insight will provide
+    uses_rollup = False  # whether execute() is passed daily sales (see r2d2.common_layer.rollups) instead of line items
+
+    def lookback_start(self, period=None, **kwargs):
+        """
+        Returns the earliest date of the transactions execute() needs for the passed
+        period and params (the im_params built by InsightDispatcher.trigger()), or None
+        if it needs the merchant's full history.  execute() may still be passed earlier
+        transactions, so it must filter on its own window
+        """
+        return None
+
+    def can_fire(self, user_id, source, period=None, **kwargs):
+        """
+        Returns False if execute() can't return an Insight for the passed period and
+        params, answered before any transactions are loaded:  by a small MongoDB query
+        or aggregation, shared through the checks param (see dailyLineItems()).  It must
+        only return False when execute() would return None.  Returns True by default
+        """
+        return True
+
+    def features(self, txns, **kwargs):
+        """
+        Returns the TransactionFeatures of txns passed by InsightDispatcher.trigger() in
+        the features param, or new ones when execute() is called without them
+        """
+        features = kwargs.get('features')
+        if features is None:
+            features = TransactionFeatures(txns)
+        return features
 
     def execute(self, user_id, source, txns, period=None, **kwargs):
         """
         The method that will generate this insight.  This will return a complete
-        message that can be displayed to the merchant
+        message that can be displayed to the merchant.  txns is shared with the other
+        InsightModels tried by InsightDispatcher.trigger(), so must not be modified
         """
         raise NotImplementedError
 
@@ -102,9 +145,9 @@ class InsightDispatcher(BaseGenerator):
     # Collections of models
     __registered_insight_models = {}
     __insight_models_df = None
-    __initial_insight_models = None  # Models that output initial insights
-    __periodic_insight_models = None  # Models that output periodic insights
-    __update_insight_models = None  # Models that output all other update insights
+    __initial_insight_models = []  # Models that output initial insights
+    __periodic_insight_models = []  # Models that output periodic insights
+    __update_insight_models = []  # Models that output all other update insights
 
     @classmethod
     def register(cls, registered_insight_model, iid):
@@ -192,10 +235,11 @@ class InsightDispatcher(BaseGenerator):
                      shows_table)
 
         cls.__insight_models_df = pd.DataFrame(zipped, columns=columns)
-        cls.__initial_insight_models = cls.__insight_models_df[cls.__insight_models_df.is_for_initial_pull]
-        cls.__periodic_insight_models = cls.__insight_models_df[~cls.__insight_models_df.periods.isnull()]
-        cls.__update_insight_models = cls.__insight_models_df[cls.__insight_models_df.is_for_update_pull &
-                                                              cls.__insight_models_df.periods.isnull()]
+        # the subcollections are lists of InsightModels, in the order of the DataFrame
+        models = cls.__registered_insight_models.values()
+        cls.__initial_insight_models = [im for im in models if im.is_for_initial_pull]
+        cls.__periodic_insight_models = [im for im in models if im.periods is not None]
+        cls.__update_insight_models = [im for im in models if im.is_for_update_pull and im.periods is None]
 
         return cls.__insight_models_df
 
@@ -243,6 +287,17 @@ class InsightDispatcher(BaseGenerator):
         The is the heart of the InsightModel choosing process.
         TODO: look at more criteria to choose InsightModel (channels, products, whether it was helpful, etc)
         """
+        return next(cls.candidate_insight_models(user_id, source, fetched_from_all, period, insight_history,
+                                                 exclude_list, is_initial), None)
+
+    @classmethod
+    def candidate_insight_models(cls, user_id, source, fetched_from_all, period=None,
+                                 insight_history=None, exclude_list=None, is_initial=False):
+        """
+        Yields every InsightModel choose_insight_model() would choose, in the order it
+        chooses them when each one chosen is excluded from the next choice.  The
+        candidates are ranked once (see rank_choices())
+        """
         # Generate the collection if not yet initialized
         if cls.__insight_models_df is None:
             cls.initialize_insight_model_subcollections()
@@ -251,14 +306,42 @@ class InsightDispatcher(BaseGenerator):
         if is_initial:  # First fetch insights
             choices = cls.__initial_insight_models
         elif period is not None:  # period insights
-            choices = cls.__periodic_insight_models
-            choices = choices[choices.periods.apply(lambda x: period in x)]  # IMs than include period in periods lists
+            choices = [im for im in cls.__periodic_insight_models if period in im.periods]
         else:  # Update insights not tied to periods
             choices = cls.__update_insight_models
 
-        im = cls.process_choices(insight_history, choices, exclude_list)
+        return cls.rank_choices(insight_history, choices, exclude_list)
+
+    @classmethod
+    def rank_choices(cls, ih, ims, exclude_list=None):
+        """
+        Yields the non-excluded InsightModels of ims lazily, in the order
+        process_choices() picks them:  priority 0 InsightModels first, then those served
+        least recently (never served first), with the highest priority, with the smallest
+        served count.  Ties keep the order of ims.
+
+        ih: iterable of InsightHistorySummary objects
+        ims: iterable of InsightModels
+        exclude_list: iterable of InsightModels objects
+        """
+        excluded_ids = set(excluded.type_id for excluded in (exclude_list or []))
+
+        # (most recent date served, count served) of each InsightModel, by type_id
+        served = {}
+        for summary in (ih if ih is not None else []):
+            history = (summary.most_recent, summary.count_insights)
+            served[summary.insight_model_id] = min(served.get(summary.insight_model_id, history), history)
 
-        return im
+        heap = []
+        for (i, im) in enumerate(ims or []):
+            if im.type_id in excluded_ids:
+                continue
+            (most_recent, count) = served.get(im.type_id, (None, 0))
+            heap.append((im.priority != 0, most_recent is not None, most_recent, -im.priority, count, i, im))
+        heapq.heapify(heap)
+
+        while heap:
+            yield heapq.heappop(heap)[-1]
 
     @classmethod
     def process_choices(cls, ih, ims, exclude_list=None):
@@ -269,72 +352,150 @@ class InsightDispatcher(BaseGenerator):
         Note that priority 0 insights are always served up unless excluded.
 
         ih: iterable of InsightHistorySummary objects
-        ims: dataframe of InsightModels
+        ims: iterable of InsightModels
         exclude_list: iterable of InsightModels objects
 
         This is a separate method so that multiple decision algorithms can be implemented
         and used interchangeably in the future.
         """
-        if ims is None or ims.shape[0] == 0:
-            return None
+        return next(cls.rank_choices(ih, ims, exclude_list), None)
 
-        # Grab IDs from exclude_list if not null
-        excluded_ids = []
-        if exclude_list is not None:
-            for excluded in exclude_list:
-                excluded_ids.append(excluded.type_id)
-
-        # get all insight_models and count of how many times they've been used,
-        # along with last used date.  Then pick the one that's been served
-        # least recently, with the highest priority, with the smallest served count
-        # SQL pseudo-code:
-        # SELECT IH.user_id,
-        #    IM.type_id,
-        #    count(IH.*),
-        #    max(IH.created),
-        #    IM.priority
-        # FROM IM
-        # LEFT JOIN IH
-        # ON IM.type_id = IH.insight_model_id
-        # GROUP BY IM.type_id, IH.user_id
-
-        ih_df = cls.insight_history_to_df(ih)
-
-        # Exclude if needed
-        choices = ims.loc[~ims.type_id.isin(excluded_ids)]
-
-        # left outer join equivalent if possible, otherwise create empty columns
-        if ih_df is not None:
-            choices = pd.merge(choices, ih_df, left_on="type_id", right_on="insight_model_id", how="left")
-        elif choices.shape[0] == 0:
-            return None
+    @classmethod
+    def load_transactions(cls, account, insight_model, start_date=None, compact=False):
+        """
+        Returns the account's transactions (or those of all the user's accounts if the
+        InsightModel compares sources) since start_date, converted to USD.  Daily sales
+        rollups are returned for InsightModels that use them.  Transactions use the
+        amounts converted at import when they were stored in USD
+        """
+        if insight_model.compares_sources:
+            account_filter = {}
         else:
-            choices.loc[:, 'count_insights'] = None
-            choices.loc[:, 'most_recent'] = None
-
-        # return a 0-priority IM if available
-        zero_priority = choices[choices.priority == 0]
-        if zero_priority.shape[0] != 0:
-            choices = zero_priority
-
-        # fill NaN and NaT then sort
-        choices.count_insights = choices.count_insights.fillna(0)
-        choices.most_recent = choices.most_recent.fillna(0)
-        choices = choices.sort_values(by=['most_recent', 'priority', 'count_insights'],
-                                      ascending=[True, False, True])
-        if choices.shape[0] == 0:
-            return None
+            account_filter = {'data_provider_name': account.__class__.__name__,
+                              'data_provider_id': account.id}
+
+        if insight_model.uses_rollup:
+            txns = daily_sales_rollup_df(account.user_id, start_date=start_date, **account_filter)
+        else:
+            txns = CTDF.find(user_id=account.user_id,
+                             start_date=start_date,
+                             snapshot=True,
+                             compact=compact,
+                             converted=True,
+                             **account_filter)
+            return curr.convert_stored_common_transactions_df(txns, 'USD', False)
 
-        # pick first off the list
-        im = cls.__registered_insight_models[choices.type_id.iloc[0]]
-        return im
+        return curr.convert_common_transactions_df(txns, 'USD', False)
 
     @classmethod
-    def trigger(cls, account, success, fetched_from_all):
+    def rank_insight_models(cls, user_id, source, fetched_from_all, period=None, insight_history=None,
+                            is_initial=False):
+        """
+        Returns every InsightModel choose_insight_model() would choose, in the order
+        trigger() tries them when each one chosen is excluded from the next choice
+        """
+        return list(cls.candidate_insight_models(user_id, source, fetched_from_all, period, insight_history,
+                                                 is_initial=is_initial))
+
+    @classmethod
+    def load_candidate_transactions(cls, account, insight_models, period, im_params, loaded, compact=False,
+                                    load_transactions=None):
+        """
+        Makes sure loaded (see trigger()) holds the transactions each of insight_models
+        needs, only reading from Mongo again if a model looks further back than the
+        frame already loaded for its kind of transactions.  Transactions are read with
+        load_transactions(), load_transactions by default
+        """
+        load_transactions = load_transactions or cls.load_transactions
+        lookbacks = OrderedDict()  # (an InsightModel, lookback starts) by (uses_rollup, compares_sources)
+        for insight_model in insight_models:
+            key = (insight_model.uses_rollup, insight_model.compares_sources)
+            lookbacks.setdefault(key, (insight_model, []))[1].append(insight_model.lookback_start(period, **im_params))
+
+        for (key, (insight_model, starts)) in lookbacks.items():
+            lookback = None if None in starts else min(starts)
+            if key not in loaded or not coversLookback(loaded[key][0], lookback):
+                txns = load_transactions(account, insight_model, lookback, compact)
+                loaded[key] = (lookback, txns, TransactionFeatures(txns))
+
+    @classmethod
+    def check_candidate(cls, account, insight_model, period, im_params, checks=None):
+        """
+        Returns whether insight_model can fire for the account (see
+        InsightModel.can_fire()), so its transactions are worth loading
+        """
+        if insight_model.can_fire(account.user_id, account.official_channel_name, period, checks=checks,
+                                  **im_params):
+            return True
+
+        logger.info("InsightModel %(insight_model)s skipped:  it can't fire" % {'insight_model': insight_model})
+        return False
+
+    @classmethod
+    def execute_candidate(cls, account, insight_model, period, im_params, loaded):
+        """
+        Executes insight_model over the transactions loaded for it (see
+        load_candidate_transactions()), and returns its (insight, channels, products),
+        all None if it gives no Insight
+        """
+        # InsightModels don't modify txns, so every candidate is passed the same frame
+        (dummy, txns, features) = loaded[(insight_model.uses_rollup, insight_model.compares_sources)]
+        (insight, channels, products) = insight_model.execute(account.user_id,
+                                                              account.official_channel_name,
+                                                              txns, period, features=features,
+                                                              **im_params) or (None, None, None)
+
+        logger.info("InsightModel %(insight_model)s resulted in Insight %(insight)s" %
+                    {'insight_model': insight_model,
+                     'insight': insight})
+        return (insight, channels, products)
+
+    @classmethod
+    def execute_candidates(cls, account, insight_models, period, im_params, loaded, compact=False, pool_size=4,
+                           load_transactions=None, checks=None):
+        """
+        Executes the ranked insight_models that can fire (see check_candidate())
+        pool_size at a time in a thread pool, over frames shared by all of them, and
+        returns the result of the highest ranked one that gives an Insight:  the same
+        result as trying them in turn.  An exception is only raised if trying them in
+        turn would have reached the model raising it.  Returns None if no model gives an
+        Insight
+        """
+        def attempt(insight_model):
+            try:
+                return (cls.execute_candidate(account, insight_model, period, im_params, loaded), None)
+            except Exception:
+                return (None, sys.exc_info())
+
+        candidates = (insight_model for insight_model in insight_models
+                      if cls.check_candidate(account, insight_model, period, im_params, checks))
+
+        pool = ThreadPool(pool_size)
+        try:
+            for batch in iter(lambda: list(itertools.islice(candidates, pool_size)), []):
+                cls.load_candidate_transactions(account, batch, period, im_params, loaded, compact, load_transactions)
+
+                for (result, error) in pool.map(attempt, batch):
+                    if error is not None:
+                        six.reraise(*error)
+                    if result[0] is not None:
+                        return result
+        finally:
+            pool.close()
+            pool.join()
+
+        return None
+
+    @classmethod
+    def trigger(cls, account, success, fetched_from_all, load_transactions=None):
         """
         The meat of the InsightDispatcher.  Checks for initial pull, whether it's
         the beginning of a new period, and generates an insight based on those
         criteria.
+
+        load_transactions:  optional replacement for load_transactions(), with the same
+            arguments, such as the transactions of a batch of users read at once (see
+            r2d2.insights.batch)
         """
         from r2d2.insights.models import Insight, InsightHistorySummary
         im_params = {}
@@ -348,7 +509,6 @@ class InsightDispatcher(BaseGenerator):
         # ih = Insight.objects.filter(user_id=1, channel__official_channel_name='Etsy')
         insight_history = InsightHistorySummary.objects.filter(user_id=account.user_id)
         insight = None
-        already_tried = []
 
         # History for this source to know if this is the first Insight
         count = 0
@@ -369,7 +529,9 @@ class InsightDispatcher(BaseGenerator):
                          'account': account}
         elif (period is not None):  # Week/Month/Year insight
             week_end = None
+            month_start = None
             month_end = None
+            year_start = None
             year_end = None
             if period == 'week':
                 week_end = end_date
@@ -393,53 +555,38 @@ class InsightDispatcher(BaseGenerator):
             im_params = {'rolling_window': rolling_window,
                          'account': account}
 
-        all_txns_df = None
-        all_txns_for_source_df = None
+        loaded = {}  # (start date, converted txns, TransactionFeatures) by (uses_rollup, compares_sources)
+        checks = {}  # results of the MongoDB queries shared by the InsightModel.can_fire() calls
+        # categorical and int32 columns (see CommonTransactionDataFrame.find()) for large merchants
+        compact = getattr(settings, 'INSIGHTS_COMPACT_DTYPES', False)
+        # number of candidate InsightModels executed at once, in a thread pool, if more than 1
+        pool_size = getattr(settings, 'INSIGHTS_PARALLEL_CANDIDATES', 1)
+
+        # InsightModels in the order they're tried, ranked once
+        candidates = cls.candidate_insight_models(account.user_id,
+                                                  account.official_channel_name,
+                                                  fetched_from_all,
+                                                  period,
+                                                  insight_history,
+                                                  is_initial=is_initial)
+
+        if pool_size > 1:
+            result = cls.execute_candidates(account, list(candidates), period, im_params, loaded, compact, pool_size,
+                                            load_transactions, checks)
+            if result is None:
+                return None
+            (insight, channels, products) = result
 
         while insight is None:
-            insight_model = cls.choose_insight_model(account.user_id,
-                                                     account.official_channel_name,
-                                                     fetched_from_all,
-                                                     period,
-                                                     insight_history,
-                                                     exclude_list=already_tried,
-                                                     is_initial=is_initial)
+            insight_model = next(candidates, None)
             if insight_model is None:
                 return None
+            if not cls.check_candidate(account, insight_model, period, im_params, checks):
+                continue
 
-            already_tried.append(insight_model)
-
-            # Fetch appropriate txns data
-            if insight_model.compares_sources:
-                if all_txns_df is None:
-                    all_txns_df = curr.convert_common_transactions_df(CTDF.find(user_id=account.user_id),
-                                                                      'USD', False)
-
-                if all_txns_df is not None:
-                    txns = all_txns_df.copy()
-                else:
-                    txns = None
-            else:
-                if all_txns_for_source_df is None:
-                    all_txns_for_source_df = curr.convert_common_transactions_df(
-                                                             CTDF.find(
-                                                                       user_id=account.user_id,
-                                                                       data_provider_name=account.__class__.__name__,
-                                                                       data_provider_id=account.id),
-                                                             'USD', False)
-
-                if all_txns_for_source_df is not None:
-                    txns = all_txns_for_source_df.copy()
-                else:
-                    txns = None
-
-            (insight, channels, products) = insight_model.execute(account.user_id,
-                                                                  account.official_channel_name,
-                                                                  txns, period, **im_params) or (None, None, None)
-            
-            logger.info("InsightModel %(insight_model)s resulted in Insight %(insight)s" % 
-                        {'insight_model': insight_model,
-                         'insight': insight})
+            cls.load_candidate_transactions(account, [insight_model], period, im_params, loaded, compact,
+                                            load_transactions)
+            (insight, channels, products) = cls.execute_candidate(account, insight_model, period, im_params, loaded)
 
         if insight is not None:
             insight.is_initial = is_initial
@@ -474,7 +621,7 @@ class TopChannelInsight(InsightModel):
         if txns is None or txns.shape[0] == 0:
             return None
 
-        txnsDF = salesByChannel(txns)
+        txnsDF = self.features(txns, **kwargs).by_channel()
 
         share = txnsDF.share.max()
         source = txnsDF.source[txnsDF.share.idxmax()]
@@ -512,6 +659,13 @@ class BestRevenueWeekEverInsight(InsightModel):
         self.output_message = "Last week was your biggest ever on %(source)s!  You made %(total_rev)s, %(percent_over)s\
          more than your second best week (the week ending %(second_best_week)s)."
 
+    def can_fire(self, user_id, source, period=None, **kwargs):
+        # revenue is compared once converted to USD, so only check the week had sales
+        week_end = kwargs.get('week_end')
+        if week_end is None:
+            return True
+        return hasWeekSales(weeklyLineItems(kwargs['account'], kwargs.get('checks')), week_end)
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -524,14 +678,8 @@ class BestRevenueWeekEverInsight(InsightModel):
                ", %(percent_over)s more than your second best week (the week ending %(second_best_week)s)."]
         week_end = kwargs.get('week_end')
 
-        txnsDF = txns
         channels = channels_from_common_transactions_df(txns)
-
-        grouper = pd.TimeGrouper('1W')
-        txnsDF.index = txnsDF.date
-        txnsDF = txnsDF.groupby([grouper, 'transaction_id'])
-        # Note we can't just sum the total_total_converted column by group because it's denormalized
-        txnsDF = txnsDF.first()[['total_total_converted']].groupby(level=0).agg('sum')
+        txnsDF = self.features(txns, **kwargs).weekly_revenue()
 
         if week_end.date() != txnsDF.total_total_converted.idxmax().date():  # Not your biggest week :(
             return None
@@ -584,6 +732,12 @@ class BestUnitsWeekEverInsight(InsightModel):
         self.output_message = "Last week you sold a record number of products on %(source)s!  You sold %(total_units)s,\
          a %(percent_over)s increase over your second best week (the week ending %(second_best_week)s)."
 
+    def can_fire(self, user_id, source, period=None, **kwargs):
+        week_end = kwargs.get('week_end')
+        if week_end is None:
+            return True
+        return canBeBestWeek(weeklyLineItems(kwargs['account'], kwargs.get('checks')), week_end, 'product_quantity')
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -597,13 +751,8 @@ class BestUnitsWeekEverInsight(InsightModel):
 
         week_end = kwargs.get('week_end')
 
-        txnsDF = txns
         channels = channels_from_common_transactions_df(txns)
-
-        grouper = pd.TimeGrouper('1W')
-        txnsDF.index = txnsDF.date
-        txnsDF = txnsDF.groupby(grouper)
-        txnsDF = txnsDF.agg({'product_quantity': 'sum'})
+        txnsDF = self.features(txns, **kwargs).by_period('week')
 
         if week_end.date() != txnsDF.product_quantity.idxmax().date():  # Not your biggest week :(
             return None
@@ -656,6 +805,13 @@ class BestTransactionsWeekEverInsight(InsightModel):
         self.output_message = 'You completed more transactions on %(source)s last week than ever before!\
           %(txn_total)s transactions is a %(percent)s increase over the second place week ending %(second_best_week)s'
 
+    def can_fire(self, user_id, source, period=None, **kwargs):
+        # weekly_transactions() counts line items, as weeklyLineItems()
+        week_end = kwargs.get('week_end')
+        if week_end is None:
+            return True
+        return canBeBestWeek(weeklyLineItems(kwargs['account'], kwargs.get('checks')), week_end, 'count')
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -670,27 +826,22 @@ class BestTransactionsWeekEverInsight(InsightModel):
 
         week_end = kwargs.get('week_end')
 
-        txnsDF = txns
         channels = channels_from_common_transactions_df(txns)
+        txnsDF = self.features(txns, **kwargs).weekly_transactions()
 
-        grouper = pd.TimeGrouper('1W')
-        txnsDF.index = txnsDF.date
-        txnsDF = txnsDF.groupby(grouper)
-        txnsDF = txnsDF.agg({'transaction_id': 'count'})
-
-        if week_end.date() != txnsDF.transaction_id.idxmax().date():  # Not your biggest week :(
+        if week_end.date() != txnsDF.transaction_count.idxmax().date():  # Not your biggest week :(
             return None
 
-        total_txns = txnsDF.transaction_id.max()
+        total_txns = txnsDF.transaction_count.max()
 
         if total_txns == Decimal(0.0):
             return None
 
-        lessers = txnsDF.drop(txnsDF.transaction_id.idxmax())
-        second_best_week = lessers.transaction_id.idxmax()
+        lessers = txnsDF.drop(txnsDF.transaction_count.idxmax())
+        second_best_week = lessers.transaction_count.idxmax()
 
-        if lessers.transaction_id.max() != Decimal(0.0):
-            percent_over = (Decimal(total_txns)/Decimal(lessers.transaction_id.max())) - Decimal(1.0)
+        if lessers.transaction_count.max() != Decimal(0.0):
+            percent_over = (Decimal(total_txns)/Decimal(lessers.transaction_count.max())) - Decimal(1.0)
             output_message = msg[0] + msg[1]
         else:
             percent_over = 0.0
@@ -738,9 +889,15 @@ class PeriodProductComparisonInsight(InsightModel):
         self.compares_sources = False
         self.priority = 3
         self.shows_table = False
+        self.uses_rollup = False  # the rolling periods are anchored on the time of a transaction, not on a day
         self.output_message = 'You sold %(week_quantity)s total %(product)s in your last sales week, %(month_quantity)s\
          in your last sales month, and %(year_quantity)s in your last sales year.'
 
+    def lookback_start(self, period=None, **kwargs):
+        if kwargs.get('rolling_window', True):
+            return None  # the rolling periods end on the last transaction, however old
+        return earliestDate(kwargs.get('year_start'), kwargs.get('month_start'), kwargs.get('start_date'))
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight, Product
 
@@ -753,19 +910,20 @@ class PeriodProductComparisonInsight(InsightModel):
         year_end = kwargs.get('year_end')
 
         txnsDF = txns
+        features = self.features(txns, **kwargs)
 
         if (rolling_window is False):
-            byWeek = salesByPeriod(txnsDF, 'week', True)
+            byWeek = features.by_period('week', True)
             time_period = format_time_period_string(kwargs.get('week_start'), week_end)
         elif (rolling_window is True):
-            byWeek = salesByPeriod(txnsDF, '7 days', True)
+            byWeek = features.by_period('7 days', True)
             time_period = format_time_period_string(txnsDF.date.max() - timedelta(days=7), txnsDF.date.max())
 
         if (rolling_window is False and week_end not in byWeek.index):
             return None
         elif (rolling_window is True):
-            byMonth = salesByPeriod(txnsDF, '30 days', True)
-            byYear = salesByPeriod(txnsDF, '365 days', True)
+            byMonth = features.by_period('30 days', True)
+            byYear = features.by_period('365 days', True)
             week_end = max(byWeek.index.get_level_values(0))  # Retrieves the final timestamp
             product = byWeek.loc[week_end, ].index[0][0]
             sku = byWeek.loc[week_end, ].index[0][1]
@@ -774,8 +932,8 @@ class PeriodProductComparisonInsight(InsightModel):
             year_quantity = byYear.loc[(max(byYear.index.get_level_values(0)), product, sku)].product_quantity
             time_period = format_time_period_string(txnsDF.date.max() - timedelta(days=365), txnsDF.date.max())
         else:
-            byMonth = salesByPeriod(txnsDF, 'month', True)
-            byYear = salesByPeriod(txnsDF, 'year', True)
+            byMonth = features.by_period('month', True)
+            byYear = features.by_period('year', True)
             time_period = format_time_period_string(kwargs.get('year_start'), year_end)
 
             # choose which product
@@ -824,6 +982,7 @@ class TopPeriodInsight(InsightModel):
         self.compares_sources = False
         self.priority = 2  # the relative importance of this Insight
         self.shows_table = False  # whether this insight shows a table
+        self.uses_rollup = True
         self.output_message = "Your biggest %(period)s on %(source)s was %(periodStr)s.  You sold over %(maxTotal)s"
 
     def execute(self, user_id, source, txns, period, **kwargs):
@@ -832,7 +991,7 @@ class TopPeriodInsight(InsightModel):
             return None
 
         channels = channels_from_common_transactions_df(txns)
-        txnsDF = salesByPeriod(txns, period)
+        txnsDF = self.features(txns, **kwargs).by_period(period)
 
         maxTotal = txnsDF.product_total_converted.max()
         topPeriod = txnsDF.product_total_converted.idxmax()
@@ -894,7 +1053,7 @@ class SalesByChannelInsight(InsightModel):
         if txns is None or txns.shape[0] == 0:
             return None
 
-        txnsDF = salesByChannel(txns)
+        txnsDF = self.features(txns, **kwargs).by_channel()
         channels = channels_from_common_transactions_df(txnsDF)
 
         txnsDF = normalizeDFColumns(txnsDF)
@@ -932,19 +1091,35 @@ class DiscountPercentageInsight(InsightModel):
         self.shows_table = False
         self.output_message = '%(percentage)s of your sales on %(source)s were discounted yesterday'
 
+    def lookback_start(self, period=None, **kwargs):
+        account = kwargs.get('account')
+        if account is None or account.last_successfull_call is None:
+            return None
+        return account.last_successfull_call - timedelta(days=1)
+
+    def can_fire(self, user_id, source, period=None, **kwargs):
+        # needs sales in the day before the last successful call
+        account = kwargs.get('account')
+        if account is None or account.last_successfull_call is None:
+            return True
+        return CTDF.exists(user_id=account.user_id,
+                           data_provider_name=account.__class__.__name__,
+                           data_provider_id=account.id,
+                           start_date=self.lookback_start(period, **kwargs),
+                           end_date=account.last_successfull_call)
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
         if txns is None or txns.shape[0] == 0:
             return None
 
-        txnsDF = txns
-
         account = kwargs['account']
         end_date = account.last_successfull_call
         start_date = end_date - timedelta(days=1)
 
-        txnsDF = txnsDF.loc[(txnsDF['date'] >= start_date) & (txnsDF['date'] <= end_date)]
+        features = self.features(txns, **kwargs)
+        txnsDF = features.window(start_date, end_date)
 
         if txnsDF is None:
             return None
@@ -952,10 +1127,9 @@ class DiscountPercentageInsight(InsightModel):
         channels = channels_from_common_transactions_df(txnsDF)
 
         # Note we can't just sum the total_total_converted column by group because it's denormalized
-        txnsDF = txnsDF.groupby(['transaction_id'])
-        txnsDF = txnsDF.first()[['total_total_converted', 'total_discount_converted']]
+        txnsDF = features.by_transaction(start_date, end_date)
 
-        if txnsDF.total_total_converted.sum() != 0:
+        if txnsDF is not None and txnsDF.total_total_converted.sum() != 0:
             discount_share = abs(txnsDF.total_discount_converted.sum()/txnsDF.total_total_converted.sum())
         else:
             return None
@@ -994,27 +1168,34 @@ class DailyAverageProductsPerTransaction(InsightModel):
         self.shows_table = False
         self.output_message = 'You averaged %(average)s products per transaction yesterday on %(source)s'
 
+    def lookback_start(self, period=None, **kwargs):
+        account = kwargs.get('account')
+        if account is None or account.last_successfull_call is None:
+            return None
+        return account.last_successfull_call - timedelta(days=1)
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
         if txns is None or txns.shape[0] == 0:
             return None
 
-        txnsDF = txns
-
         account = kwargs['account']
         end_date = account.last_successfull_call
         start_date = end_date - timedelta(days=1)
 
-        txnsDF = txnsDF.loc[(txnsDF['date'] >= start_date) & (txnsDF['date'] <= end_date)]
+        features = self.features(txns, **kwargs)
+        txnsDF = features.window(start_date, end_date)
 
         if txns is None or txns.shape[0] == 0:
             return None
 
         channels = channels_from_common_transactions_df(txnsDF)
-        txnsDF = txnsDF.groupby(['transaction_id'])
-        txnsDF = txnsDF.agg({'product_name': 'count'})
-        average = txnsDF.product_name.mean()
+        txnsDF = features.by_transaction(start_date, end_date)
+        if txnsDF is None:
+            return None
+
+        average = txnsDF.product_count.mean()
 
         if math.isnan(average):
             return None
@@ -1048,6 +1229,9 @@ class WeeklyAverageProductsPerTransaction(InsightModel):
         self.shows_table = False
         self.output_message = 'Last week you averaged %(average)s products per transaction on %(source)s'
 
+    def lookback_start(self, period=None, **kwargs):
+        return kwargs.get('start_date')
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -1057,16 +1241,15 @@ class WeeklyAverageProductsPerTransaction(InsightModel):
         end_date = kwargs['end_date']
         start_date = kwargs['start_date']
 
-        txnsDF = txns.loc[(txns['date'] >= start_date) & (txns['date'] <= end_date)]
+        features = self.features(txns, **kwargs)
+        txnsDF = features.window(start_date, end_date)
 
         if txnsDF is None or txnsDF.shape[0] == 0:
             return None
 
         channels = channels_from_common_transactions_df(txnsDF)
 
-        txnsDF = txnsDF.groupby(['transaction_id'])
-        txnsDF = txnsDF.agg({'product_name': 'count'})
-        average = txnsDF.product_name.mean()
+        average = features.by_transaction(start_date, end_date).product_count.mean()
 
         if math.isnan(average):
             return None
@@ -1106,9 +1289,18 @@ class AverageTransactionsPerPeriodInsight(InsightModel):
         self.compares_sources = False
         self.priority = 4
         self.shows_table = False
+        self.uses_rollup = True
         self.output_message = 'You averaged %(current_average)s transactions per week last month.  \
         This is %(percent_diff)s %(more_or_less)s than the previous month'
 
+    def lookback_start(self, period=None, **kwargs):
+        start_date = kwargs.get('start_date')
+        if start_date is None or period not in self.periods:
+            return None
+        elif period == 'month':  # compared to the previous month
+            return getPreviousMonth(start_date)[0]
+        return getPreviousYear(start_date)[0]  # compared to the previous year
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -1122,18 +1314,15 @@ class AverageTransactionsPerPeriodInsight(InsightModel):
         end_date = kwargs['end_date']
         start_date = kwargs['start_date']
 
-        this_period_txns = txnsDF.loc[(txnsDF['date'] >= start_date) & (txnsDF['date'] <= end_date)]
+        features = self.features(txns, **kwargs)
+        this_period_txns = features.weekly_transactions(start_date, end_date)
 
         if this_period_txns is None or this_period_txns.shape[0] == 0:
             return None
 
         channels = channels_from_common_transactions_df(txnsDF)
 
-        grouper = pd.TimeGrouper('1W')
-        this_period_txns.index = this_period_txns.date
-        this_period_txns = this_period_txns.groupby(grouper)
-        this_period_txns = this_period_txns.agg({'transaction_id': 'count'})
-        current_average = this_period_txns.transaction_id.mean()
+        current_average = this_period_txns.transaction_count.fillna(0).mean()  # weeks without sales are NaN
 
         if math.isnan(current_average):
             return None
@@ -1147,18 +1336,15 @@ class AverageTransactionsPerPeriodInsight(InsightModel):
                    '  This is %(percent_diff)s %(more_or_less)s than the previous year']
             (start_date, end_date) = getPreviousYear(start_date)
 
-        last_period_txns = txnsDF.loc[(txnsDF['date'] >= start_date) & (txnsDF['date'] <= end_date)]
+        last_period_txns = features.weekly_transactions(start_date, end_date)
 
         # If no txns in previous period then don't include the second sentence in the output
-        if last_period_txns.shape[0] == 0:
+        if last_period_txns is None:
             msg[1] = ''
             percent_diff = 0.0
             more_or_less = ''
         else:
-            last_period_txns.index = last_period_txns.date
-            last_period_txns = last_period_txns.groupby(grouper)
-            last_period_txns = last_period_txns.agg({'transaction_id': 'count'})
-            previous_average = last_period_txns.transaction_id.mean()
+            previous_average = last_period_txns.transaction_count.fillna(0).mean()
 
             if math.isnan(previous_average) or previous_average == 0.0:
                 msg[1] = ''
@@ -1209,6 +1395,9 @@ class TopProductsInsight(InsightModel):
         self.shows_table = True
         self.output_message = 'Here\'s last %(period)s\'s sales breakdown<br><br> %(table)s '
 
+    def lookback_start(self, period=None, **kwargs):
+        return kwargs.get('start_date')
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
@@ -1219,7 +1408,7 @@ class TopProductsInsight(InsightModel):
         end_date = kwargs['end_date']
 
         channels = channels_from_common_transactions_df(txns)
-        txnsDF = topProducts(txns, start_date, end_date)
+        txnsDF = self.features(txns, **kwargs).by_product(start_date, end_date)
 
         if txnsDF is None or txnsDF.shape[0] == 0:
             return None
@@ -1259,27 +1448,31 @@ class DailyProductSalesInsight(InsightModel):
         self.shows_table = True
         self.output_message = 'Here\'s yesterday\'s sales breakdown for %(source)s<br><br> %(table)s '
 
+    def lookback_start(self, period=None, **kwargs):
+        account = kwargs.get('account')
+        if account is None or account.last_successfull_call is None:
+            return None
+        return account.last_successfull_call - timedelta(days=1)
+
     def execute(self, user_id, source, txns, period, **kwargs):
         from r2d2.insights.models import Insight
 
         if txns is None or txns.shape[0] == 0:
             return None
 
-        txnsDF = txns
-
         account = kwargs['account']
         end_date = account.last_successfull_call
         start_date = end_date - timedelta(days=1)
 
-        txnsDF = txnsDF.loc[(txnsDF['date'] >= start_date) & (txnsDF['date'] <= end_date)]
+        features = self.features(txns, **kwargs)
+        txnsDF = features.window(start_date, end_date)
 
         if txnsDF is None or txnsDF.shape[0] == 0:
             return None
 
         channels = channels_from_common_transactions_df(txnsDF)
 
-        txnsDF = txnsDF.groupby(['product_name'])
-        txnsDF = txnsDF.agg({'product_quantity': 'sum', 'product_total_converted': 'sum'})
+        txnsDF = features.by_product(start_date, end_date).set_index('product_name').sort_index()
 
         txnsDF = normalizeDFColumns(txnsDF)
         txnsDF = txnsDF[['Item Quantity', 'Item Total']]
@@ -1324,7 +1517,7 @@ class BestSellingProductsInsight(InsightModel):
             return None
 
         channels = channels_from_common_transactions_df(txns)
-        txnsDF = topProducts(txns, None, None)
+        txnsDF = self.features(txns, **kwargs).by_product()
 
         if txnsDF is None or txnsDF.shape[0] == 0:
             return None
@@ -1517,7 +1710,7 @@ class ProductMultiplesInsight(InsightModel):
         # don't want to deal with the multiindex but need to group
         dfgrouped = txnsDF.groupby(['transaction_id', 'product_name'], as_index=False)
         # sum product_quantities in each group in case multiple of the same item are listed individually
-        txnsDF = dfgrouped.agg('sum')
+        txnsDF = dfgrouped.agg({'product_quantity': 'sum'})
         txnsDF = mode(txnsDF, ['product_name'], txnsDF.product_quantity, 'count')
         txnsDF = txnsDF[txnsDF.product_quantity > 1]
 
@@ -1539,11 +1732,151 @@ class ProductMultiplesInsight(InsightModel):
         return(insight, channels, None)
 
 
+class TransactionFeatures(object):
+    """
+    Aggregates of one frame of converted transactions (or daily sales rollups), computed
+    lazily and at most once.  InsightDispatcher.trigger() builds one per loaded frame and
+    passes it to every InsightModel it tries as the features param, so candidates that
+    group the frame the same way share the result.  It is safe to share between the
+    threads of InsightDispatcher.execute_candidates()
+
+    Returned frames are shared between InsightModels and must not be modified in place
+    """
+    def __init__(self, txns):
+        self.txns = txns
+        self.cache = {}
+        self.lock = threading.RLock()
+
+    def cached(self, key, fn, *args):
+        """ Returns fn(*args), computed on the first call with key only, by one thread at a time """
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = fn(*args)
+            return self.cache[key]
+
+    def window(self, start_date=None, end_date=None):
+        """ Returns the transactions from start_date to end_date (inclusive), or all of them without both """
+        if self.txns is None or start_date is None or end_date is None:
+            return self.txns
+
+        def select():
+            return self.txns.loc[(self.txns['date'] >= start_date) & (self.txns['date'] <= end_date)]
+
+        return self.cached(('window', start_date, end_date), select)
+
+    def by_period(self, period, by_product=False):
+        """ Returns salesByPeriod() of the transactions """
+        if self.txns is None:
+            return None
+        return self.cached(('by_period', period, by_product), salesByPeriod, self.txns, period, by_product)
+
+    def by_channel(self):
+        """ Returns salesByChannel() of the transactions """
+        return self.cached(('by_channel', ), salesByChannel, self.txns)
+
+    def by_product(self, start_date=None, end_date=None):
+        """ Returns topProducts() of the transactions from start_date to end_date """
+        return self.cached(('by_product', start_date, end_date), topProducts, self.txns, start_date, end_date)
+
+    def by_transaction(self, start_date=None, end_date=None):
+        """
+        Returns the totals of each transaction from start_date to end_date, and the
+        number of line items it has as product_count.  The totals can't be summed over
+        line items since they're denormalized
+        """
+        def aggregate():
+            txns = self.window(start_date, end_date)
+            if txns is None or txns.shape[0] == 0:
+                return None
+
+            txns = dropUnusedCategories(txns).groupby(['transaction_id'])
+            totals = txns[['total_total_converted', 'total_discount_converted']].first()
+            totals['product_count'] = txns.agg({'product_name': 'count'}).product_name
+            return totals
+
+        return self.cached(('by_transaction', start_date, end_date), aggregate)
+
+    def weekly_revenue(self):
+        """ Returns the total_total_converted sum of the transactions of each calendar week """
+        def aggregate():
+            if self.txns is None or self.txns.shape[0] == 0:
+                return None
+
+            txns = self.txns.groupby([pd.TimeGrouper('1W', key='date'), 'transaction_id'])
+            return txns[['total_total_converted']].first().groupby(level=0).agg('sum')
+
+        return self.cached(('weekly_revenue', ), aggregate)
+
+    def weekly_transactions(self, start_date=None, end_date=None):
+        """
+        Returns the number of transactions of each calendar week from start_date to
+        end_date, as transaction_count:  the number of line items, summed from the
+        transaction_count of daily sales rollups.  Weeks without sales are NaN
+        """
+        def aggregate():
+            txns = self.window(start_date, end_date)
+            if txns is None or txns.shape[0] == 0:
+                return None
+
+            if 'transaction_count' in txns.columns:
+                return txns.groupby(pd.TimeGrouper('1W', key='date')).agg({'transaction_count': 'sum'})
+            txns = txns.groupby(pd.TimeGrouper('1W', key='date')).agg({'transaction_id': 'count'})
+            return txns.rename(columns={'transaction_id': 'transaction_count'})
+
+        return self.cached(('weekly_transactions', start_date, end_date), aggregate)
+
+
+def isChunked(txns):
+    """
+    Returns True if txns is an iterable of DataFrame chunks, such as the one returned
+    by CommonTransactionDataFrame.find(chunksize=...), rather than a single DataFrame
+    """
+    return txns is not None and not isinstance(txns, pd.DataFrame)
+
+
+def concatPartials(partials, reset_index=False):
+    """
+    Concatenates the partial aggregates computed for each chunk, skipping empty ones,
+    so that the aggregate can be applied again to combine them.
+    Returns None if there are no partial results
+    """
+    if reset_index:
+        partials = [partial.reset_index() for partial in partials if partial is not None and partial.shape[0] != 0]
+    else:
+        partials = [partial for partial in partials if partial is not None and partial.shape[0] != 0]
+
+    if len(partials) == 0:
+        return None
+
+    return pd.concat(partials, ignore_index=True)
+
+
+def dropUnusedCategories(df):
+    """
+    Returns df with the categories not present in categorical columns removed, such as
+    after filtering a frame from CommonTransactionDataFrame.find(compact=True).  pandas
+    0.18 returns every category when grouping by a single categorical column, and every
+    combination when counting or taking the first row of groups.
+    Frames without categorical columns are returned as is
+    """
+    categorical = [column for column in df.columns if df[column].dtype.name == 'category']
+    if len(categorical) == 0:
+        return df
+
+    return df.assign(**dict((column, df[column].cat.remove_unused_categories()) for column in categorical))
+
+
 def salesByChannel(txnsDF):
     """
     Returns a DataFrame of sales and quantities grouped by channel
     If the transactions list is empty return None
+
+    txnsDF may also be an iterable of DataFrame chunks, in which case the channel
+    sums of each chunk are combined before shares are computed
     """
+    if isChunked(txnsDF):
+        txnsDF = concatPartials(salesByChannel(chunk) for chunk in txnsDF)
+
     if txnsDF is None or txnsDF.shape[0] == 0:
         return None
 
@@ -1577,9 +1910,20 @@ def salesByPeriod(txns, period, by_product=False):
     hour:    by hour, on the hour
     by_product: if True groups by product_name and product_sku.  Defaults to False
 
+    txns may also be an iterable of DataFrame chunks, in which case the period sums
+    of each chunk are combined.  Only calendar periods are supported for chunks, since
+    the '7 days', '30 days' and '365 days' periods are anchored on the first date of
+    the data.
+
     TODO:  should period just be the frequency offset from
     http://pandas.pydata.org/pandas-docs/stable/timeseries.html#offset-aliases?
     """
+    if isChunked(txns):
+        if period in ['7 days', '30 days', '365 days']:
+            raise ValueError('Period %s cannot be combined across chunks' % period)
+
+        txns = concatPartials((salesByPeriod(chunk, period, by_product) for chunk in txns), reset_index=True)
+
     if txns is None or txns.shape[0] == 0:
         return None
 
@@ -1608,8 +1952,7 @@ def salesByPeriod(txns, period, by_product=False):
         return None
 
     # Group by date frequency and by product if needed
-    grouper = pd.TimeGrouper(freq)
-    txns.index = txns.date
+    grouper = pd.TimeGrouper(freq, key='date')
 
     if (by_product):
         txns = txns.groupby([grouper, 'product_name', 'product_sku'])
@@ -1626,7 +1969,14 @@ def topProducts(txnsDF, start_date=None, end_date=None):
     """
     Takes a list of CommonTransaction objects, returns an HTML table of
     products with quantity and totals summed
+
+    txnsDF may also be an iterable of DataFrame chunks, in which case the product
+    sums of each chunk are combined
     """
+    if isChunked(txnsDF):
+        txnsDF = concatPartials(topProducts(chunk, start_date, end_date) for chunk in txnsDF)
+        start_date = end_date = None  # already applied to each chunk
+
     if txnsDF is None or txnsDF.shape[0] == 0:
         return None
 
@@ -1636,7 +1986,7 @@ def topProducts(txnsDF, start_date=None, end_date=None):
     if txnsDF.shape[0] == 0:
         return None
 
-    txnsDF = txnsDF.groupby(['product_name'], as_index=False)
+    txnsDF = dropUnusedCategories(txnsDF).groupby(['product_name'], as_index=False)
     txnsDF = txnsDF.agg({'product_quantity': 'sum', 'product_total_converted': 'sum'})
     txnsDF = txnsDF.sort_values(by=['product_total_converted', 'product_quantity'], ascending=False)
 
@@ -1756,6 +2106,9 @@ def summary(df, fn=np.sum, axis=0, name='Total',  table_class_prefix='dataframe-
     From:  http://blog.henryhhammond.com/pandas-formatting-snippets/#addingasummaryrowcolumn
 
     """
+    if axis == 0 and df.index.dtype.name == 'category':  # the summary label isn't one of the categories
+        df = df.set_index(df.index.astype(object))
+
     total = df.apply(fn, axis=axis).to_frame(name)
 
     table_class = ""
@@ -1855,6 +2208,93 @@ def getPreviousPeriod(fromDate, numDays):
     return (firstDay, lastDay)
 
 
+def earliestDate(*dates):
+    """
+    Returns the earliest of the passed dates, ignoring None.  Returns None if
+    all of them are None
+    """
+    dates = [date for date in dates if date is not None]
+    if len(dates) == 0:
+        return None
+    return min(dates)
+
+
+def dailyLineItems(account, checks=None):
+    """
+    Returns the account's line items summed by (UTC) day in MongoDB (see
+    CommonTransactionDataFrame.aggregate()):  their product_quantity and their number
+    as count, indexed by date.  Kept in checks, a dict shared by the
+    InsightModel.can_fire() calls of a dispatch
+    """
+    key = ('daily_line_items', account.__class__.__name__, account.id)
+    if checks is not None and key in checks:
+        return checks[key]
+
+    daily = CTDF.aggregate(user_id=account.user_id,
+                           data_provider_name=account.__class__.__name__,
+                           data_provider_id=account.id)
+    daily = pd.DataFrame({'date': pd.to_datetime(daily.date),
+                          'product_quantity': daily.product_quantity.astype(float),
+                          'count': daily['count'].astype(np.int64)})
+    daily = daily.groupby('date')[['product_quantity', 'count']].sum()
+
+    if checks is not None:
+        checks[key] = daily
+    return daily
+
+
+def weeklyLineItems(account, checks=None):
+    """
+    Returns dailyLineItems() summed by calendar week, as salesByPeriod(..., 'week')
+    groups line items, or None if the account has none
+    """
+    daily = dailyLineItems(account, checks)
+    if daily.shape[0] == 0:
+        return None
+    return daily.groupby(pd.TimeGrouper('1W')).sum()
+
+
+def hasWeekSales(weekly, week_end):
+    """ Returns whether weekly (see weeklyLineItems()) has line items in the week ending week_end """
+    week = pd.Timestamp(week_end.date())
+    return weekly is not None and week in weekly.index and weekly['count'][week] > 0
+
+
+def canBeBestWeek(weekly, week_end, column):
+    """
+    Returns False if the week ending week_end can't be the week with the largest
+    column of weekly (see weeklyLineItems()):  it has no sales, its sum is zero, or it's
+    short of another week.  Sums of the line items in a frame may round differently,
+    so near ties count as the largest
+    """
+    if not hasWeekSales(weekly, week_end):
+        return False
+
+    values = weekly[column]
+    week = values[pd.Timestamp(week_end.date())]
+    return week != 0 and week >= values.max() - abs(values.max()) * 1e-9
+
+
+def coversLookback(loaded_start, lookback):
+    """
+    Returns True if transactions loaded since loaded_start include everything since
+    lookback (see InsightModel.lookback_start()).  Either one may be None for the
+    full history.  Naive dates are assumed to be UTC, as stored by MongoDB
+    """
+    if loaded_start is None:
+        return True
+    elif lookback is None:
+        return False
+
+    (loaded_start, lookback) = (pd.Timestamp(loaded_start), pd.Timestamp(lookback))
+    if loaded_start.tzinfo is not None:
+        loaded_start = loaded_start.tz_convert(None)
+    if lookback.tzinfo is not None:
+        lookback = lookback.tz_convert(None)
+
+    return loaded_start <= lookback
+
+
 def format_time_period_string(from_date, to_date=None):
     '''
     Formats the passed from_date and to_date into a string indicating time period:
@@ -1984,7 +2424,7 @@ def mode(df, key_cols, value_col, count_col):
     taken from:
     http://stackoverflow.com/questions/15222754/group-by-pandas-dataframe-and-select-most-common-string-factor
     """
-    return (df.groupby(key_cols + [value_col]).size()
+    return (dropUnusedCategories(df).groupby(key_cols + [value_col]).size()
             .to_frame(count_col).reset_index()
             .sort_values(count_col, ascending=False)
             .drop_duplicates(subset=key_cols))
@@ -0,0 +1,51 @@
+""" generate the insights of every approved user in shards """
+from django.core.management.base import BaseCommand
+
+from r2d2.insights.batch import approved_user_ids, generate_insights, shards
+from r2d2.insights.tasks import generate_insights_task
+
+
+class Command(BaseCommand):
+    """
+    Runs InsightDispatcher for the data provider accounts of every approved user (or
+    only the passed ones), shard_size users at a time, and writes a progress line per
+    user.  Shards run over a local pool of processes, or are queued as Celery tasks
+    (see r2d2.insights.batch).
+    """
+    help = 'Generates the insights of every approved user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, dest='user_ids', action='append', default=None,
+                            help='Only generate the insights of this user (can be repeated)')
+        parser.add_argument('--shard-size', type=int, dest='shard_size', default=100,
+                            help='Number of users whose transactions are read at once')
+        parser.add_argument('--processes', type=int, dest='processes', default=1,
+                            help='Number of shards generated at once, in worker processes')
+        parser.add_argument('--queue', action='store_true', dest='queue', default=False,
+                            help='Queue a Celery task per shard instead of generating them here')
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids'] or approved_user_ids()
+
+        if options['queue']:
+            user_shards = shards(user_ids, options['shard_size'])
+            for user_shard in user_shards:
+                generate_insights_task.delay(user_shard)
+            self.stdout.write('%d users queued in %d shards' % (len(user_ids), len(user_shards)))
+            return
+
+        (users, insights, errors) = (0, 0, 0)
+        for progress in generate_insights(user_ids, options['shard_size'], options['processes']):
+            users += 1
+            insights += progress['insights']
+            if progress['error'] is None:
+                self.stdout.write('[%d/%d] user %d: %d insights from %d accounts in %.2fs' %
+                                  (users, len(user_ids), progress['user_id'], progress['insights'],
+                                   progress['accounts'], progress['seconds']))
+            else:
+                errors += 1
+                self.stderr.write('[%d/%d] user %d failed after %.2fs: %s' %
+                                  (users, len(user_ids), progress['user_id'], progress['seconds'],
+                                   progress['error']))
+
+        self.stdout.write('%d insights generated for %d users, %d failed' % (insights, users, errors))
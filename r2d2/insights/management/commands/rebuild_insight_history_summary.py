@@ -0,0 +1,22 @@
+""" rebuild the insight history summary from served Insights """
+from django.core.management.base import BaseCommand
+
+from r2d2.insights.models import InsightHistorySummary
+
+
+class Command(BaseCommand):
+    """
+    Recomputes InsightHistorySummary from the served Insights, for every user or only
+    the passed one.  Only needed if Insights were changed without going through
+    Insight.save() or delete(), e.g. by a bulk update.
+    """
+    help = 'Rebuilds the insight history summary from Insights'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user-id', type=int, dest='user_id', default=None,
+                            help='Only rebuild the summary of this user')
+
+    def handle(self, *args, **options):
+        count = InsightHistorySummary.rebuild(options['user_id'])
+
+        self.stdout.write('%d insight history summaries rebuilt' % count)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('insights', '0003_auto_20170515_1703'),
+    ]
+
+    view_sql = "CREATE VIEW insights_insight_history_summary AS \
+    SELECT max(ii.id) as id, \
+        ii.user_id, \
+        ii.insight_model_id, \
+        count(ii.insight_model_id) as count_insights, \
+        max(ii.created) as most_recent \
+    FROM insights_insight ii \
+    GROUP BY ii.insight_model_id, ii.user_id;"
+
+    summarize_sql = "INSERT INTO insights_insight_history_summary \
+        (user_id, insight_model_id, count_insights, most_recent) \
+    SELECT ii.user_id, \
+        ii.insight_model_id, \
+        count(ii.id), \
+        max(ii.created) \
+    FROM insights_insight ii \
+    GROUP BY ii.user_id, ii.insight_model_id;"
+
+    operations = [
+        migrations.RunSQL("DROP VIEW IF EXISTS insights_insight_history_summary;", view_sql),
+        migrations.DeleteModel(
+            name='InsightHistorySummary',
+        ),
+        migrations.CreateModel(
+            name='InsightHistorySummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('insight_model_id', models.IntegerField()),
+                ('count_insights', models.IntegerField()),
+                ('most_recent', models.DateTimeField()),
+                ('user', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'insights_insight_history_summary',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='insighthistorysummary',
+            unique_together=set([('user', 'insight_model_id')]),
+        ),
+        migrations.RunSQL(summarize_sql, migrations.RunSQL.noop),
+    ]
@@ -1,14 +1,15 @@
 # -*- coding: utf-8 -*-
 """ insights models """
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Max
+from django.db.models.signals import post_delete, post_save
 from django.utils import timezone
 
 from r2d2.accounts.models import Account
 from r2d2.insights.generators import InsightDispatcher
 from r2d2.insights.signals import data_fetched
-from r2d2.insights.signals import insight_post_save
+from r2d2.insights.signals import insight_post_delete, insight_post_save
 
 
 IMAGE_CONTENT_TYPES = set([
@@ -51,6 +52,22 @@ class Insight(models.Model):
     data_provider_name = models.CharField(max_length=200, editable=False)
     data_provider_id = models.IntegerField()
 
+    def save(self, *args, **kwargs):
+        """ Saves the Insight and updates InsightHistorySummary in the same transaction """
+        with transaction.atomic():
+            # the summaries the Insight is counted in before and after the save
+            keys = set()
+            if self.pk is not None:
+                keys.update(Insight.objects.filter(pk=self.pk).values_list('user_id', 'insight_model_id'))
+
+            result = super(Insight, self).save(*args, **kwargs)
+
+            keys.add((self.user_id, self.insight_model_id))
+            for (user_id, insight_model_id) in keys:
+                InsightHistorySummary.refresh(user_id, insight_model_id)
+
+        return result
+
 
 class Product(models.Model):
     """
@@ -82,19 +99,81 @@ class Channel(models.Model):
 
 class InsightHistorySummary(models.Model):
     """
-    Unmanaged model for the insights_insight_history_summary view that summarizes
-    how many of each InsightModel have been served, and what the most recent date
-    is for each
+    Summarizes how many of each InsightModel have been served to each user, and what
+    the most recent date is for each, so InsightDispatcher reads one row per
+    InsightModel instead of grouping every Insight served.  Updated in the transaction
+    saving (see Insight.save()) or deleting (see insight_post_delete) an Insight, and
+    rebuilt from the Insights by the rebuild_insight_history_summary command
     """
-    id = models.IntegerField(primary_key=True)  # Placeholder id only, not meaningful
-    user = models.ForeignKey(Account, on_delete=models.DO_NOTHING)
+    user = models.ForeignKey(Account)
     insight_model_id = models.IntegerField()
     count_insights = models.IntegerField()
     most_recent = models.DateTimeField()
 
     class Meta:
-        managed = False
         db_table = 'insights_insight_history_summary'
+        unique_together = (('user', 'insight_model_id'),)
+
+    @classmethod
+    def refresh(cls, user_id, insight_model_id):
+        """
+        Recomputes the summary of the user's Insights of the InsightModel.  The summary
+        is locked before the Insights are counted, so that a concurrent save waits for
+        this one to commit and then counts its Insight too.  If a concurrent save
+        creates the summary first, it is updated instead
+        """
+        with transaction.atomic():
+            summaries = cls.objects.select_for_update().filter(user_id=user_id, insight_model_id=insight_model_id)
+            summary = summaries.first()
+            values = cls.summarize(user_id, insight_model_id)
+
+            if values['count_insights'] == 0:
+                summaries.delete()
+                return
+
+            if summary is None:
+                try:
+                    with transaction.atomic():  # a savepoint, so that the outer transaction survives the IntegrityError
+                        cls.objects.create(user_id=user_id, insight_model_id=insight_model_id, **values)
+                    return
+                except IntegrityError:
+                    # the concurrent save committed the summary:  lock it, and count its Insight too
+                    summary = summaries.get()
+                    values = cls.summarize(user_id, insight_model_id)
+
+            summary.count_insights = values['count_insights']
+            summary.most_recent = values['most_recent']
+            summary.save(update_fields=['count_insights', 'most_recent'])
+
+    @classmethod
+    def summarize(cls, user_id, insight_model_id):
+        """
+        Returns the count_insights and most_recent of the user's Insights of the
+        InsightModel.  They're read with a locking read, which sees the Insights
+        committed since the transaction began under MySQL's REPEATABLE READ
+        """
+        return Insight.objects.select_for_update().filter(user_id=user_id, insight_model_id=insight_model_id)\
+            .aggregate(count_insights=Count('id'), most_recent=Max('created'))
+
+    @classmethod
+    def rebuild(cls, user_id=None):
+        """
+        Recomputes the summaries of every user (or only the passed one) from their
+        Insights.  Returns the number of summaries
+        """
+        insights = Insight.objects.all()
+        summaries = cls.objects.all()
+        if user_id is not None:
+            insights = insights.filter(user_id=user_id)
+            summaries = summaries.filter(user_id=user_id)
+
+        with transaction.atomic():
+            rows = list(insights.values('user_id', 'insight_model_id').order_by('user_id', 'insight_model_id')
+                        .annotate(count_insights=Count('id'), most_recent=Max('created')))
+            summaries.delete()
+            cls.objects.bulk_create([cls(**row) for row in rows])
+
+        return len(rows)
 
 
 def validate_file_extension(value):
@@ -130,6 +209,7 @@ class InsightAttachment(models.Model):
 
 
 post_save.connect(insight_post_save, sender=Insight)
+post_delete.connect(insight_post_delete, sender=Insight)
 
 # IMPORTANT! order of connect will be the order of insights
 data_fetched.connect(InsightDispatcher.handle_data_fetched)
@@ -23,3 +23,10 @@ def insight_post_save(sender, instance, created, **kwargs):
     if send_notification:
         # it goes through task since on the post_save we don't have attachments yet
         connection.on_commit(lambda: send_insight_task.apply_async([instance.pk], countdown=5))
+
+
+def insight_post_delete(sender, instance, **kwargs):
+    """ Updates InsightHistorySummary in the transaction deleting the Insight """
+    from r2d2.insights.models import InsightHistorySummary
+
+    InsightHistorySummary.refresh(instance.user_id, instance.insight_model_id)
@@ -72,3 +72,11 @@ Each time you add a new channel you\'ll get an email with an insight for that ch
                     'channel_names': channel_str})
     except Insight.DoesNotExist:
         pass
+
+
+@app.task
+def generate_insights_task(user_ids):
+    """ Generates the insights of a shard of users, see r2d2.insights.batch.generate_shard_insights() """
+    from r2d2.insights.batch import generate_shard_insights
+
+    return generate_shard_insights(user_ids)
@@ -2,13 +2,19 @@
 """ tests for insights generation """
 from datetime import datetime, timedelta
 from decimal import Decimal
+from multiprocessing.pool import ThreadPool
+import time
 from freezegun import freeze_time
+import mock
 
+from django.core.management import call_command
+from django.db.models.query import QuerySet
 from django.utils import timezone
 import pandas as pd
 import numpy as np
 
 from r2d2.common_layer.models import CommonTransaction
+from r2d2.common_layer.rollups import DailySalesRollup, daily_sales_rollup_df, rebuild_daily_sales_rollup
 from r2d2.insights.models import Insight, InsightHistorySummary
 from r2d2.insights.generators import InsightDispatcher, InsightModel, DataImportedInsight,\
     AverageProductsPerTransactions, AverageTransactionsPerWeek
@@ -51,6 +57,14 @@ class InsightsAPITestCase(APIBaseTestCase):
             data_provider_id=account.id
         )
 
+    def _convert(self, txnsDF):
+        """ Adds the converted money columns of txnsDF at a rate of 1, in place, and returns it """
+        txnsDF['value'] = Decimal(1.0)
+        for column in clmodels.get_money_columns():
+            if column in txnsDF:
+                txnsDF[column+'_converted'] = txnsDF[column] * txnsDF.value
+        return txnsDF
+
     def create_insight_history(self, user, date, registered):
         plus_hour = timedelta(minutes=60)
         ct_account = ShopifyStore.objects.create(user=user,
@@ -204,8 +218,37 @@ class InsightsAPITestCase(APIBaseTestCase):
         #    2) At least one InsightModel is returned if the exclude_list is empty
         #    3) No insights are returned if the exclude_list contains all available InsightModels
         self.assertEqual(InsightDispatcher.process_choices(ih, None), None)
-        self.assertTrue(isinstance(InsightDispatcher.process_choices(ih, models_as_df), InsightModel))
-        self.assertEqual(InsightDispatcher.process_choices(ih, models_as_df, list(registered_models.values())), None)
+        self.assertTrue(isinstance(InsightDispatcher.process_choices(ih, registered_models.values()), InsightModel))
+        self.assertEqual(InsightDispatcher.process_choices(ih, registered_models.values(),
+                                                           list(registered_models.values())), None)
+
+    def test_rank_choices(self):
+        """
+        InsightModels are ranked priority 0 first, then least recently served (never
+        served first), then highest priority, then least served, as process_choices()
+        picks them in turn
+        """
+        ims = sorted(InsightDispatcher.get_registered_models().values(), key=lambda im: im.type_id)
+        now = timezone.now()
+        ih = [InsightHistorySummary(user_id=1, insight_model_id=im.type_id, count_insights=i % 3,
+                                    most_recent=now - timedelta(days=i % 4))
+              for (i, im) in enumerate(ims) if i % 5 != 0]
+        served = dict((summary.insight_model_id, summary) for summary in ih)
+
+        def rank(im):
+            summary = served.get(im.type_id)
+            if summary is None:
+                return (im.priority != 0, False, None, -im.priority, 0)
+            return (im.priority != 0, True, summary.most_recent, -im.priority, summary.count_insights)
+
+        ranked = list(InsightDispatcher.rank_choices(ih, ims))
+        self.assertEqual(ranked, sorted(ims, key=rank))
+
+        excluded = []
+        for im in ranked:
+            self.assertEqual(InsightDispatcher.process_choices(ih, ims, excluded), im)
+            excluded.append(im)
+        self.assertEqual(InsightDispatcher.process_choices(ih, ims, excluded), None)
 
     def test_data_frame_functions(self):
         """
@@ -215,10 +258,7 @@ class InsightsAPITestCase(APIBaseTestCase):
         normalizeDFColumns
         """
         txns = CommonTransaction.objects.all()
-        txnsDF = clmodels.common_transactions_to_df(txns)
-        txnsDF['value'] = Decimal(1.0)
-        for column in clmodels.get_money_columns():
-            txnsDF[column+'_converted'] = txnsDF[column] * txnsDF.value
+        txnsDF = self._convert(clmodels.common_transactions_to_df(txns))
 
         # salesByChannel
         out = gen.salesByChannel(txnsDF)
@@ -297,6 +337,383 @@ class InsightsAPITestCase(APIBaseTestCase):
                       'value': 'Exchange Rate'}
         self.assertTrue(test.rename(columns=columnDict).equals(gen.normalizeDFColumns(txnsDF)))
 
+    def test_chunked_aggregations(self):
+        """
+        salesByChannel, salesByPeriod and topProducts give the same results for an
+        iterable of DataFrame chunks as for the whole DataFrame
+        """
+        txns = CommonTransaction.objects.all()
+        txnsDF = self._convert(clmodels.common_transactions_to_df(txns))
+
+        def chunks():
+            return [txnsDF.iloc[i:i + 4].copy() for i in range(0, txnsDF.shape[0], 4)]
+
+        out = gen.salesByChannel(chunks())
+        test = gen.salesByChannel(txnsDF.copy())
+        self.assertEqual(out.product_quantity.tolist(), test.product_quantity.tolist())
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+        self.assertEqual(out.share.tolist(), test.share.tolist())
+
+        for period in ['year', 'quarter', 'month', 'week', 'day']:
+            for by_product in [False, True]:
+                out = gen.salesByPeriod(chunks(), period, by_product)
+                test = gen.salesByPeriod(txnsDF.copy(), period, by_product)
+                self.assertTrue(out.index.equals(test.index))
+                self.assertTrue(out.product_quantity.equals(test.product_quantity))
+                self.assertTrue(out.product_total_converted.equals(test.product_total_converted))
+        self.assertRaises(ValueError, gen.salesByPeriod, chunks(), '7 days')
+
+        out = gen.topProducts(chunks())
+        test = gen.topProducts(txnsDF.copy())
+        self.assertEqual(out.product_name.tolist(), test.product_name.tolist())
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        self.assertEqual(gen.salesByChannel(iter([])), None)
+        self.assertEqual(gen.topProducts(iter([])), None)
+
+    def test_aggregation_pipelines(self):
+        """
+        salesByChannel, salesByPeriod and topProducts give the same results for the
+        aggregates of CommonTransactionDataFrame.aggregate as for the line items, and
+        CommonTransactionDataFrame.quantity_modes matches mode
+        """
+        txnsDF = self._convert(clmodels.CommonTransactionDataFrame.find())
+
+        out = gen.salesByChannel(self._convert(clmodels.CommonTransactionDataFrame.aggregate()))
+        test = gen.salesByChannel(txnsDF.copy())
+        self.assertEqual(out.product_quantity.tolist(), test.product_quantity.tolist())
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        for period in ['year', 'quarter', 'month', 'week', 'day', 'hour']:
+            for by_product in [False, True]:
+                aggDF = clmodels.CommonTransactionDataFrame.aggregate(by_product=by_product, by_hour=(period == 'hour'))
+                out = gen.salesByPeriod(self._convert(aggDF), period, by_product)
+                test = gen.salesByPeriod(txnsDF.copy(), period, by_product)
+                self.assertTrue(out.index.equals(test.index))
+                self.assertEqual(out.product_quantity.fillna(0).tolist(), test.product_quantity.fillna(0).tolist())
+                self.assertEqual(out.product_total_converted.fillna(0).tolist(),
+                                 test.product_total_converted.fillna(0).tolist())
+
+        out = gen.topProducts(self._convert(clmodels.CommonTransactionDataFrame.aggregate(by_product=True)))
+        test = gen.topProducts(txnsDF.copy())
+        self.assertEqual(out.product_name.tolist(), test.product_name.tolist())
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        out = clmodels.CommonTransactionDataFrame.quantity_modes()
+        test = txnsDF[['transaction_id', 'product_name', 'product_quantity']]
+        test = test.groupby(['transaction_id', 'product_name'], as_index=False).agg('sum')
+        test = gen.mode(test, ['product_name'], 'product_quantity', 'count')
+        self.assertEqual(out.product_quantity.tolist(), test.product_quantity.tolist())
+        self.assertEqual(out['count'].tolist(), test['count'].tolist())
+
+        self.assertEqual(clmodels.CommonTransactionDataFrame.aggregate(user_id=-1).shape[0], 0)
+
+    def test_compact_frames(self):
+        """
+        salesByChannel, salesByPeriod, topProducts and mode give the same results for
+        frames with categorical columns, including once filtered
+        """
+        txnsDF = clmodels.CommonTransactionDataFrame.find()
+        compactDF = clmodels.compact_dtypes(txnsDF.copy())
+        for df in [txnsDF, compactDF]:
+            self._convert(df)
+
+        out = gen.salesByChannel(compactDF.copy())
+        test = gen.salesByChannel(txnsDF.copy())
+        self.assertEqual(list(out.source), list(test.source))
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        out = gen.salesByPeriod(compactDF.copy(), 'day', True)
+        test = gen.salesByPeriod(txnsDF.copy(), 'day', True)
+        self.assertTrue(out.index.equals(test.index))
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        start_date = datetime(2016, 4, 28)
+        end_date = datetime(2016, 4, 29)
+        out = gen.topProducts(compactDF[compactDF.transaction_id != '1'], start_date, end_date)
+        test = gen.topProducts(txnsDF[txnsDF.transaction_id != '1'], start_date, end_date)
+        self.assertEqual(list(out.product_name), list(test.product_name))
+        self.assertEqual(out.product_total_converted.tolist(), test.product_total_converted.tolist())
+
+        out = gen.mode(compactDF[compactDF.transaction_id != '1'], ['transaction_id'], 'product_name', 'count')
+        test = gen.mode(txnsDF[txnsDF.transaction_id != '1'], ['transaction_id'], 'product_name', 'count')
+        self.assertEqual(sorted(out['count'].tolist()), sorted(test['count'].tolist()))
+
+    def test_lookback_windows(self):
+        """
+        InsightModels only ask for the transactions their period needs, and give the same
+        insight for them as for the full history
+        """
+        (start_date, end_date) = gen.getPreviousWeek(datetime(2016, 5, 2))
+        params = {'rolling_window': False, 'start_date': start_date, 'end_date': end_date}
+
+        im = gen.WeeklyAverageProductsPerTransaction()
+        self.assertEqual(im.lookback_start('week', **params), start_date)
+        self.assertIsNone(gen.TopPeriodInsight().lookback_start('week', **params))
+        self.assertIsNone(gen.PeriodProductComparisonInsight().lookback_start('week', rolling_window=True))
+
+        month_params = {'start_date': datetime(2016, 3, 1), 'end_date': datetime(2016, 3, 31)}
+        self.assertEqual(gen.AverageTransactionsPerPeriodInsight().lookback_start('month', **month_params),
+                         datetime(2016, 2, 1))
+        self.assertEqual(gen.PeriodProductComparisonInsight().lookback_start('week',
+                                                                             year_start=datetime(2015, 1, 1),
+                                                                             month_start=datetime(2016, 3, 1),
+                                                                             **params),
+                         datetime(2015, 1, 1))
+
+        self.assertTrue(gen.coversLookback(None, start_date))
+        self.assertTrue(gen.coversLookback(start_date, end_date))
+        self.assertFalse(gen.coversLookback(end_date, start_date))
+        self.assertFalse(gen.coversLookback(start_date, None))
+        self.assertTrue(gen.coversLookback(timezone.make_aware(start_date, timezone.utc), end_date))
+
+        full = clmodels.CommonTransactionDataFrame.find()
+        windowed = clmodels.CommonTransactionDataFrame.find(start_date=im.lookback_start('week', **params))
+        self.assertLess(windowed.shape[0], full.shape[0])
+        for df in [full, windowed]:
+            self._convert(df)
+
+        (out, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', windowed, 'week', **params)
+        (test, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', full, 'week', **params)
+        self.assertEqual(out.text, test.text)
+
+    def test_transaction_features(self):
+        """
+        TransactionFeatures aggregates each grouping once, and InsightModels give the
+        same insight with shared features as without
+        """
+        txnsDF = self._convert(clmodels.CommonTransactionDataFrame.find())
+
+        features = gen.TransactionFeatures(txnsDF)
+        self.assertIs(features.by_period('week'), features.by_period('week'))
+        self.assertIs(features.by_channel(), features.by_channel())
+        self.assertTrue(features.by_period('week', True).equals(gen.salesByPeriod(txnsDF.copy(), 'week', True)))
+        self.assertEqual(features.by_product().product_name.tolist(),
+                         gen.topProducts(txnsDF.copy()).product_name.tolist())
+        self.assertEqual(features.weekly_transactions().transaction_count.sum(), txnsDF.shape[0])
+        self.assertEqual(features.by_transaction().product_count.sum(), txnsDF.product_name.count())
+        self.assertEqual(features.weekly_revenue().total_total_converted.sum(),
+                         features.by_transaction().total_total_converted.sum())
+        self.assertIsNone(gen.TransactionFeatures(txnsDF.iloc[:0]).by_transaction())
+
+        calls = []
+
+        def slowly():
+            calls.append(None)
+            time.sleep(0.01)
+            return len(calls)
+
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(pool.map(lambda i: features.cached(('slowly', ), slowly), range(8)), [1] * 8)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(len(calls), 1)
+
+        (start_date, end_date) = gen.getPreviousWeek(datetime(2016, 5, 2))
+        params = {'rolling_window': False, 'start_date': start_date, 'end_date': end_date}
+        for im in [gen.WeeklyAverageProductsPerTransaction(), gen.TopProductsInsight(), gen.SalesByChannelInsight()]:
+            (out, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', txnsDF.copy(), 'week',
+                                             features=features, **params)
+            (test, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', txnsDF.copy(), 'week', **params)
+            self.assertEqual(out.text, test.text)
+
+        # daily sales rollups count transactions as line items do
+        rebuild_daily_sales_rollup(self.account.user_id)
+        rollupDF = self._convert(daily_sales_rollup_df(self.account.user_id))
+        DailySalesRollup.objects.all().delete()
+        self.assertEqual(gen.TransactionFeatures(rollupDF).weekly_transactions().transaction_count.tolist(),
+                         features.weekly_transactions().transaction_count.tolist())
+
+        im = gen.AverageTransactionsPerPeriodInsight()
+        params = {'rolling_window': False, 'start_date': datetime(2016, 4, 1), 'end_date': datetime(2016, 4, 30)}
+        (out, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', rollupDF, 'month', **params)
+        (test, dummy, dummy) = im.execute(self.account.user_id, 'Shopify', txnsDF, 'month', **params)
+        self.assertEqual(out.text, test.text)
+
+    def test_models_keep_transactions(self):
+        """
+        No registered InsightModel modifies the transactions it's passed, since
+        InsightDispatcher.trigger() passes the same frame to every model it tries
+        """
+        txnsDF = self._convert(clmodels.CommonTransactionDataFrame.find())
+        rollupDF = txnsDF.groupby(['date', 'source', 'data_provider_name', 'data_provider_id', 'product_name',
+                                   'product_sku'], as_index=False).agg({'product_quantity': 'sum',
+                                                                        'product_total_converted': 'sum',
+                                                                        'transaction_id': 'count'})
+        rollupDF = rollupDF.rename(columns={'transaction_id': 'transaction_count'})
+
+        self.account.last_successfull_call = datetime(2016, 4, 29)
+        (start_date, end_date) = gen.getPreviousWeek(datetime(2016, 5, 2))
+        params = {'rolling_window': False, 'start_date': start_date, 'end_date': end_date, 'week_end': end_date,
+                  'account': self.account}
+
+        for im in InsightDispatcher.list_registered():
+            txns = rollupDF if im.uses_rollup else txnsDF
+            for period in (im.periods or [None]):
+                test = txns.copy()
+                im.execute(self.account.user_id, 'Shopify', txns, period, **params)
+                self.assertTrue(txns.equals(test), im.__class__.__name__)
+                self.assertTrue(txns.index.equals(test.index), im.__class__.__name__)
+
+    def test_parallel_candidates(self):
+        """
+        Executing the ranked InsightModels in a thread pool gives the insight of the
+        first one that gives an insight, as trying them in turn does
+        """
+        txnsDF = self._convert(clmodels.CommonTransactionDataFrame.find())
+        # the same frame for every kind of transactions, already covering every lookback
+        loaded = dict(((uses_rollup, compares_sources), (None, txnsDF, gen.TransactionFeatures(txnsDF)))
+                      for uses_rollup in [True, False] for compares_sources in [True, False])
+
+        self.account.last_successfull_call = datetime(2016, 4, 29)
+        ih = InsightHistorySummary.objects.filter(user_id=self.account.user_id)
+        ranked = InsightDispatcher.rank_insight_models(self.account.user_id, 'Shopify', True, None, ih)
+        self.assertEqual(len(ranked), len(set(ranked)))
+        self.assertEqual(ranked[0], InsightDispatcher.choose_insight_model(self.account.user_id, 'Shopify', True,
+                                                                           None, ih))
+
+        params = {'rolling_window': True, 'account': self.account}
+        for insight_model in ranked:
+            (test, channels, products) = InsightDispatcher.execute_candidate(self.account, insight_model, None,
+                                                                             params, loaded)
+            if test is not None:
+                break
+
+        for pool_size in [2, 4, len(ranked)]:
+            (out, channels, products) = InsightDispatcher.execute_candidates(self.account, ranked, None, params,
+                                                                             loaded, pool_size=pool_size)
+            self.assertEqual(out.insight_model_id, test.insight_model_id)
+            self.assertEqual(out.text, test.text)
+        self.assertIsNone(InsightDispatcher.execute_candidates(self.account, [], None, params, loaded))
+
+    def test_can_fire(self):
+        """
+        InsightModels only report they can't fire, before loading transactions, when
+        executing them gives no insight
+        """
+        txnsDF = self._convert(clmodels.CommonTransactionDataFrame.find())
+
+        self.account.last_successfull_call = datetime(2016, 4, 29)
+        checks = {}
+        fired = set()
+        for im in [gen.BestRevenueWeekEverInsight(), gen.BestUnitsWeekEverInsight(),
+                   gen.BestTransactionsWeekEverInsight()]:
+            for week_end in [datetime(2016, 4, 17), datetime(2016, 4, 24), datetime(2016, 5, 1)]:
+                params = {'rolling_window': False, 'week_start': week_end - timedelta(days=6),
+                          'week_end': week_end.replace(hour=23, minute=59, second=59), 'account': self.account}
+                if not im.can_fire(self.account.user_id, 'Shopify', 'week', checks=checks, **params):
+                    self.assertIsNone(im.execute(self.account.user_id, 'Shopify', txnsDF, 'week', **params))
+                else:
+                    fired.add(week_end)
+        # no sales in the week ending 2016-04-17
+        self.assertNotIn(datetime(2016, 4, 17), fired)
+        self.assertEqual(len(checks), 1)
+
+        im = gen.DiscountPercentageInsight()
+        params = {'rolling_window': True, 'account': self.account}
+        self.assertTrue(im.can_fire(self.account.user_id, 'Shopify', **params))
+        self.account.last_successfull_call = datetime(2016, 4, 27)
+        self.assertFalse(im.can_fire(self.account.user_id, 'Shopify', **params))
+        self.assertIsNone(im.execute(self.account.user_id, 'Shopify', txnsDF, None, **params))
+
+    def test_shard_transactions(self):
+        """
+        The transactions of a shard of users are read with one query, and split into
+        the transactions InsightDispatcher.load_transactions() reads for each account
+        and InsightModel
+        """
+        from r2d2.insights.batch import ShardTransactions, shards, split_by_user
+
+        self.assertEqual(shards([1, 2, 3, 4, 5], 2), [[1, 2], [3, 4], [5]])
+
+        user_ids = [self.account.user_id, self.account.user_id + 1]
+        txnsDF = clmodels.CommonTransactionDataFrame.find(user_id=user_ids)
+        self.assertTrue(txnsDF.equals(clmodels.CommonTransactionDataFrame.find(user_id=self.account.user_id)))
+
+        shard = ShardTransactions(user_ids)
+        shard.frames[False] = split_by_user(txnsDF)
+        self.assertEqual(sorted(shard.frames[False].keys()), [self.account.user_id])
+
+        account_txns = clmodels.CommonTransactionDataFrame.find(user_id=self.account.user_id,
+                                                                data_provider_name=self.account.__class__.__name__,
+                                                                data_provider_id=self.account.id)
+        for im in InsightDispatcher.list_registered():
+            if im.uses_rollup:
+                continue
+            out = shard.load(self.account, im)
+            test = txnsDF if im.compares_sources else account_txns
+            self.assertEqual(out.shape, test.shape, im.__class__.__name__)
+            self.assertEqual(out.transaction_id.tolist(), test.transaction_id.tolist())
+
+        shard.release(self.account.user_id)
+        self.assertEqual(shard.frames[False], {})
+
+        # compact line items are read since the earliest start date asked for
+        find = clmodels.CommonTransactionDataFrame.find
+        im = next(im for im in InsightDispatcher.list_registered() if not im.uses_rollup)
+        shard = ShardTransactions(user_ids, compact=True)
+        with mock.patch.object(clmodels.CommonTransactionDataFrame, 'find', side_effect=find) as mocked_find:
+            for start_date in [datetime(2016, 4, 20), datetime(2016, 4, 25), datetime(2016, 4, 1)]:
+                shard.load(self.account, im, start_date)
+        self.assertEqual([kwargs['start_date'] for (args, kwargs) in mocked_find.call_args_list],
+                         [datetime(2016, 4, 20), datetime(2016, 4, 1)])
+        self.assertTrue(all(kwargs['compact'] for (args, kwargs) in mocked_find.call_args_list))
+
+    def test_insight_history_summary(self):
+        """
+        InsightHistorySummary counts the Insights of each InsightModel as they're saved
+        and deleted, and rebuild_insight_history_summary rebuilds the same summaries
+        """
+        user = self.account.user
+        (first, second) = sorted(InsightDispatcher.get_registered_models().values(), key=lambda im: im.type_id)[:2]
+        for (days, registered) in [(2, [first, second]), (1, [first])]:
+            for im in registered:
+                Insight.objects.create(user=user, created=timezone.now() - timedelta(days=days), text='test',
+                                       generator_class=InsightDispatcher.__class__.__name__,
+                                       insight_model_id=im.type_id, is_initial=False,
+                                       data_provider_name=self.account.__class__.__name__,
+                                       data_provider_id=self.account.id)
+
+        def summaries():
+            return list(InsightHistorySummary.objects.filter(user=user).order_by('insight_model_id')
+                        .values_list('insight_model_id', 'count_insights', 'most_recent'))
+
+        def most_recent(im):
+            return Insight.objects.filter(user=user, insight_model_id=im.type_id).latest('created').created
+
+        self.assertEqual(summaries(), [(first.type_id, 2, most_recent(first)),
+                                       (second.type_id, 1, most_recent(second))])
+
+        Insight.objects.filter(user=user, insight_model_id=first.type_id).latest('created').delete()
+        self.assertEqual(summaries(), [(first.type_id, 1, most_recent(first)),
+                                       (second.type_id, 1, most_recent(second))])
+
+        # moving an Insight to another InsightModel updates both summaries
+        insight = Insight.objects.get(user=user, insight_model_id=second.type_id)
+        insight.insight_model_id = first.type_id
+        insight.save()
+        self.assertEqual(summaries(), [(first.type_id, 2, most_recent(first))])
+
+        expected = summaries()
+        Insight.objects.filter(user=user).update(insight_model_id=second.type_id)
+        call_command('rebuild_insight_history_summary', user_id=user.id)
+        self.assertEqual(summaries(), [(second.type_id, 2, most_recent(second))])
+
+        Insight.objects.filter(user=user).update(insight_model_id=first.type_id)
+        call_command('rebuild_insight_history_summary')
+        self.assertEqual(summaries(), expected)
+
+        # a concurrent save created the summary after this one looked it up
+        insight.insight_model_id = second.type_id
+        InsightHistorySummary.objects.create(user=user, insight_model_id=second.type_id, count_insights=0,
+                                             most_recent=timezone.now())
+        with mock.patch.object(QuerySet, 'first', return_value=None):
+            insight.save()
+        self.assertEqual(summaries(), [(first.type_id, 1, most_recent(first)),
+                                       (second.type_id, 1, most_recent(second))])
+
     def test_time_functions(self):
         """
         Test generators.py support functions having to do with time: